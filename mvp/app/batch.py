@@ -0,0 +1,169 @@
+# Public Domain (-) 2017 The GitFund Authors.
+# See the GitFund UNLICENSE file for details.
+
+"""Batching of datastore gets, puts and deletes into multi-entity RPCs."""
+
+import logging
+
+from google.appengine.ext import db
+
+# ------------------------------------------------------------------------------
+# Constants
+# ------------------------------------------------------------------------------
+
+# The maximum number of keys or entities sent in a single RPC.
+MAX_GET_SIZE = 1000
+MAX_WRITE_SIZE = 500
+
+# ------------------------------------------------------------------------------
+# Futures
+# ------------------------------------------------------------------------------
+
+class Future(object):
+
+    __slots__ = ('batcher', 'done', 'error', 'value')
+
+    def __init__(self, batcher):
+        self.batcher = batcher
+        self.done = False
+        self.error = None
+        self.value = None
+
+    def get_result(self):
+        if not self.done:
+            self.batcher.flush()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def set_error(self, error):
+        self.done = True
+        self.error = error
+
+    def set_result(self, value):
+        self.done = True
+        self.value = value
+
+# ------------------------------------------------------------------------------
+# Batcher
+# ------------------------------------------------------------------------------
+
+# A ``Batcher`` collects the gets, puts and deletes made within a scope, and
+# returns a ``Future`` for each of them. Everything that is pending is sent
+# when the result of any of the futures is first needed, or when the scope is
+# exited. All the writes are sent in parallel, and then all the gets, so that
+# gets see the writes which were queued before them. Keys which are asked for
+# more than once are only fetched once, and their futures share the entity.
+#
+# The ``STATS`` count the operations that were queued, along with the RPCs
+# that were actually made, so the number of RPCs saved by batching is the
+# difference. The counters are approximate, as they aren't updated under a
+# lock.
+STATS = dict.fromkeys(['deletes', 'gets', 'puts', 'rpcs'], 0)
+
+class Batcher(object):
+
+    def __init__(self):
+        self.deletes = []
+        self.gets = []
+        self.puts = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+            return
+        # Keep the original error if the pending writes can't be made either.
+        try:
+            self.flush()
+        except Exception, err:
+            logging.error("Error flushing datastore batch: %r" % err)
+
+    def delete(self, key):
+        future = Future(self)
+        self.deletes.append((key, future))
+        STATS['deletes'] += 1
+        return future
+
+    def get(self, key):
+        future = Future(self)
+        self.gets.append((key, future))
+        STATS['gets'] += 1
+        return future
+
+    def put(self, entity):
+        future = Future(self)
+        self.puts.append((entity, future))
+        STATS['puts'] += 1
+        return future
+
+    def flush(self):
+        deletes, gets, puts = self.deletes, self.gets, self.puts
+        self.deletes = []
+        self.gets = []
+        self.puts = []
+        rpcs = []
+        for idx in range(0, len(puts), MAX_WRITE_SIZE):
+            chunk = puts[idx:idx+MAX_WRITE_SIZE]
+            rpcs.append((
+                chunk, db.put_async([entity for entity, _ in chunk])
+            ))
+        for idx in range(0, len(deletes), MAX_WRITE_SIZE):
+            chunk = deletes[idx:idx+MAX_WRITE_SIZE]
+            rpcs.append((
+                chunk, db.delete_async([key for key, _ in chunk])
+            ))
+        STATS['rpcs'] += len(rpcs)
+        error = resolve_writes(rpcs)
+        if gets:
+            resolve_gets(gets)
+        # Failed writes are raised, as their futures are rarely looked at.
+        if error is not None:
+            raise error
+
+# Set the results of the futures for the given write RPCs, and return the first
+# error, if any.
+def resolve_writes(rpcs):
+    error = None
+    for chunk, rpc in rpcs:
+        try:
+            results = rpc.get_result()
+        except Exception, err:
+            for _, future in chunk:
+                future.set_error(err)
+            if error is None:
+                error = err
+            continue
+        if results is None:
+            results = [None] * len(chunk)
+        for (_, future), result in zip(chunk, results):
+            future.set_result(result)
+    return error
+
+def resolve_gets(gets):
+    keys = []
+    seen = set()
+    for key, _ in gets:
+        if key not in seen:
+            keys.append(key)
+            seen.add(key)
+    rpcs = []
+    for idx in range(0, len(keys), MAX_GET_SIZE):
+        chunk = keys[idx:idx+MAX_GET_SIZE]
+        rpcs.append((chunk, db.get_async(chunk)))
+    STATS['rpcs'] += len(rpcs)
+    entities = {}
+    for chunk, rpc in rpcs:
+        try:
+            entities.update(zip(chunk, rpc.get_result()))
+        except Exception, err:
+            for key in chunk:
+                entities[key] = err
+    for key, future in gets:
+        entity = entities[key]
+        if isinstance(entity, Exception):
+            future.set_error(entity)
+        else:
+            future.set_result(entity)
@@ -0,0 +1,134 @@
+# Public Domain (-) 2017 The GitFund Authors.
+# See the GitFund UNLICENSE file for details.
+
+"""Content negotiation and compression for weblite responses."""
+
+from collections import OrderedDict
+from threading import Lock
+from zlib import DEFLATED, compressobj
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# ------------------------------------------------------------------------------
+# Constants
+# ------------------------------------------------------------------------------
+
+COMPRESSIBLE_TYPES = frozenset([
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+    'text/css',
+    'text/csv',
+    'text/html',
+    'text/javascript',
+    'text/plain',
+    'text/xml',
+    ])
+
+GZIP_LEVEL = 6
+
+BROTLI_QUALITY = 5
+
+# The encodings we can produce, in order of preference when a client accepts
+# more than one with the same quality value.
+if brotli:
+    ENCODINGS = ('br', 'gzip')
+else:
+    ENCODINGS = ('gzip',)
+
+# ------------------------------------------------------------------------------
+# Negotiation
+# ------------------------------------------------------------------------------
+
+# There are only a handful of distinct ``Accept-Encoding`` values in practice,
+# so the results of parsing them are memoised.
+def select_encoding(accept_encoding, cache={}, max_entries=256):
+    if accept_encoding in cache:
+        return cache[accept_encoding]
+    if len(cache) >= max_entries:
+        cache.clear()
+    return cache.setdefault(
+        accept_encoding, parse_accept_encoding(accept_encoding)
+        )
+
+def parse_accept_encoding(accept_encoding):
+    qvalues = {}
+    for part in accept_encoding.lower().split(','):
+        coding, _, params = part.partition(';')
+        coding = coding.strip()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        qvalues[coding] = q
+    wildcard = qvalues.get('*', 0.0)
+    selected = None
+    best = 0.0
+    for encoding in ENCODINGS:
+        q = qvalues.get(encoding, wildcard)
+        if q > best:
+            selected, best = encoding, q
+    return selected
+
+# ------------------------------------------------------------------------------
+# Compression
+# ------------------------------------------------------------------------------
+
+def compress(data, encoding):
+    if encoding == 'gzip':
+        # A wbits value of 16 + 15 gets zlib to emit a gzip header/trailer.
+        compressor = compressobj(GZIP_LEVEL, DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    raise ValueError("Unsupported content encoding: %r" % encoding)
+
+# The ``VariantCache`` holds the compressed variants of responses which are
+# served from server-side caches, so that they aren't recompressed on every
+# hit. It is an in-process LRU bounded by the total size of the variants.
+class VariantCache(object):
+
+    def __init__(self, max_size=8 << 20):
+        self.data = OrderedDict()
+        self.lock = Lock()
+        self.max_size = max_size
+        self.size = 0
+
+    def get(self, key, encoding, data):
+        ident = (key, encoding)
+        with self.lock:
+            variant = self.data.pop(ident, None)
+            if variant is not None:
+                length, body = variant
+                # Guard against a key being reused for different content.
+                if length == len(data):
+                    self.data[ident] = variant
+                    return body
+                self.size -= len(body)
+        body = compress(data, encoding)
+        if len(body) > self.max_size:
+            return body
+        with self.lock:
+            previous = self.data.pop(ident, None)
+            if previous is not None:
+                self.size -= len(previous[1])
+            self.data[ident] = (len(data), body)
+            self.size += len(body)
+            while self.size > self.max_size:
+                _, (_, evicted) = self.data.popitem(last=False)
+                self.size -= len(evicted)
+        return body
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.size = 0
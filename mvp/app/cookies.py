@@ -0,0 +1,129 @@
+# Public Domain (-) 2017 The GitFund Authors.
+# See the GitFund UNLICENSE file for details.
+
+"""Minimal codec for the request and response cookies used by weblite."""
+
+from Cookie import _getdate, _quote, _unquote
+
+# ------------------------------------------------------------------------------
+# Constants
+# ------------------------------------------------------------------------------
+
+# The supported cookie attributes, in the order in which they are output, along
+# with their names in the ``Set-Cookie`` header. These match the output of the
+# stdlib ``SimpleCookie``.
+COOKIE_ATTRIBUTES = (
+    ('domain', 'Domain'),
+    ('expires', 'expires'),
+    ('httponly', 'httponly'),
+    ('max_age', 'Max-Age'),
+    ('path', 'Path'),
+    ('secure', 'secure'),
+    )
+
+COOKIE_FLAGS = frozenset(['httponly', 'secure'])
+
+# ------------------------------------------------------------------------------
+# Parser
+# ------------------------------------------------------------------------------
+
+# Return the value of the named cookie from a ``Cookie`` request header, or
+# ``None`` if it isn't present. Only the named cookie is looked at, so callers
+# can parse cookies lazily as they are needed. As with ``SimpleCookie``, the
+# last value wins if a cookie is repeated, and quoted values are unquoted.
+#
+# Quoted values are skipped over when looking for the name, so that text
+# within them, e.g. the ``auth=`` in ``c="v auth=evil"``, isn't mistaken for a
+# cookie.
+def get_cookie_value(header, name):
+    prefix = name + '='
+    plen = len(prefix)
+    value = None
+    scan = 0
+    idx = header.find(prefix)
+    while idx != -1:
+        quote = find_value_quote(header, scan, idx)
+        if quote != -1:
+            scan = find_quote_end(header, quote + 1)
+            if scan > idx:
+                idx = header.find(prefix, scan)
+            continue
+        # Make sure that we've matched the whole of the cookie name.
+        if idx == 0 or header[idx - 1] in '; \t':
+            start = idx + plen
+            while header[start:start + 1] in (' ', '\t'):
+                start += 1
+            if header[start:start + 1] == '"':
+                end = header.find('"', start + 1)
+                value = header[start + 1:end]
+                # Only values with escapes need to be fully unquoted.
+                if end == -1 or '\\' in value:
+                    end = find_quote_end(header, start + 1)
+                    value = _unquote(header[start:end])
+                else:
+                    end += 1
+            else:
+                end = header.find(';', start)
+                if end == -1:
+                    end = len(header)
+                value = header[start:end].rstrip()
+            scan = end
+            idx = header.find(prefix, end)
+        else:
+            idx = header.find(prefix, idx + plen)
+    return value
+
+def find_value_quote(header, start, end):
+    idx = header.find('"', start, end)
+    while idx != -1:
+        # Only quotes that open a value count, i.e. ones following an ``=``.
+        pos = idx - 1
+        while pos >= 0 and header[pos] in ' \t':
+            pos -= 1
+        if pos >= 0 and header[pos] == '=':
+            return idx
+        idx = header.find('"', idx + 1, end)
+    return -1
+
+def find_quote_end(header, idx):
+    length = len(header)
+    while idx < length:
+        char = header[idx]
+        if char == '\\':
+            idx += 2
+            continue
+        if char == '"':
+            return idx + 1
+        idx += 1
+    return length
+
+# ------------------------------------------------------------------------------
+# Serializer
+# ------------------------------------------------------------------------------
+
+# Return the ``Set-Cookie`` header value for a cookie, where ``attrs`` is a dict
+# of the lowercased cookie attributes, e.g. ``max_age``. Values are quoted in
+# the same way as ``SimpleCookie``, so that existing cookies round-trip.
+def format_set_cookie(name, value, attrs):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        value = str(value)
+    out = [name + '=' + _quote(value)]
+    append = out.append
+    for key, label in COOKIE_ATTRIBUTES:
+        if key not in attrs:
+            continue
+        if key in COOKIE_FLAGS:
+            append(label)
+            continue
+        attr = attrs[key]
+        if isinstance(attr, unicode):
+            attr = attr.encode('utf-8')
+        if key == 'max_age':
+            append('%s=%d' % (label, attr))
+        elif key == 'expires' and isinstance(attr, (int, long)):
+            append('%s=%s' % (label, _getdate(attr)))
+        else:
+            append('%s=%s' % (label, attr))
+    return '; '.join(out)
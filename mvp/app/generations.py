@@ -0,0 +1,104 @@
+# Public Domain (-) 2017 The GitFund Authors.
+# See the GitFund UNLICENSE file for details.
+
+"""Generation counters for invalidating groups of cached values."""
+
+from time import time
+
+from google.appengine.api.memcache import (
+    add as add_cache, get as get_cache, get_multi as get_cache_multi,
+    incr as incr_cache
+    )
+
+from google.appengine.ext.db import run_in_transaction
+
+from model import CacheGeneration
+
+# ------------------------------------------------------------------------------
+# Constants
+# ------------------------------------------------------------------------------
+
+# Each seeding of a generation from the datastore starts a new epoch, which
+# makes up the high bits of the generation values.
+EPOCH_SHIFT = 32
+
+NAMESPACE = 'generation'
+
+# Instances re-check a generation in memcache at most this often, in seconds.
+POLL_INTERVAL = 5
+
+# ------------------------------------------------------------------------------
+# Generations
+# ------------------------------------------------------------------------------
+
+# Cached values are stored under keys which include the current generation of
+# the data they were derived from. Instead of deleting the keys when the data
+# changes, writers bump the generation, so that concurrent readers can't put
+# stale values back under the keys that are then read, and old values simply
+# age out of memcache.
+#
+# Bumps are atomic increments in memcache, so concurrent bumps never move a
+# generation backwards, and don't need a datastore write. If the value has been
+# evicted, it is re-seeded by bumping the epoch in the datastore, so that the
+# new values are greater than any that were handed out before the eviction, and
+# every generation value is still only ever used once.
+LOCAL = {}
+
+def get_generation(name):
+    return get_generations([name])[name]
+
+# Return a dict of the current generations for the given names.
+def get_generations(names, poll_interval=POLL_INTERVAL):
+    now = time()
+    generations = {}
+    to_get = []
+    for name in names:
+        entry = LOCAL.get(name)
+        if entry is not None and (now - entry[1]) < poll_interval:
+            generations[name] = entry[0]
+        else:
+            to_get.append(name)
+    if not to_get:
+        return generations
+    cache = get_cache_multi(to_get, namespace=NAMESPACE)
+    for name in to_get:
+        value = cache.get(name)
+        if value is None:
+            value = seed_generation(name)
+        generations[name] = value
+        LOCAL[name] = (value, now)
+    return generations
+
+def seed_generation(name):
+    value = run_in_transaction(bump_epoch_txn, name) << EPOCH_SHIFT
+    if add_cache(name, value, namespace=NAMESPACE):
+        return value
+    current = get_cache(name, namespace=NAMESPACE)
+    if current is None:
+        return value
+    return current
+
+def bump_epoch_txn(name):
+    entity = CacheGeneration.get_by_key_name(name)
+    if not entity:
+        entity = CacheGeneration(key_name=name)
+    entity.value += 1
+    entity.put()
+    return entity.value
+
+# Bump the generations for the given names. This should be called after the
+# underlying data has been changed.
+def bump_generations(*names):
+    for name in names:
+        value = incr_cache(name, namespace=NAMESPACE)
+        if value is None:
+            seeded = seed_generation(name)
+            value = incr_cache(name, namespace=NAMESPACE)
+            # Memcache is unavailable, but the new epoch is still greater than
+            # any value that was seen before the bump.
+            if value is None:
+                value = seeded
+        # Other threads may have already seen a later bump.
+        entry = LOCAL.get(name)
+        if entry is None or entry[0] < value:
+            LOCAL[name] = (value, time())
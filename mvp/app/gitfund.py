@@ -7,17 +7,19 @@ import logging
 import re
 import xml.etree.ElementTree as ET
 
-from base64 import b32encode, b64encode
+from base64 import b32decode, b32encode, b64encode
 from cgi import escape
 from collections import namedtuple
+from cStringIO import StringIO
+from csv import writer as csv_writer
 from datetime import datetime, timedelta
 from decimal import Decimal, ROUND_HALF_UP
 from hashlib import sha256
 from json import dumps as encode_json, loads as decode_json
-from random import choice
-from struct import pack
-from thread import allocate_lock
-from threading import local
+from operator import itemgetter
+from random import choice, random
+from struct import pack, unpack
+from threading import Condition, local
 from time import time
 from urllib import urlencode
 
@@ -33,23 +35,27 @@ from config import (
 )
 
 from model import (
-    BetaProject, DonorTotals, ExchangeRates, GitHubProfile, GitHubRepo, Login,
-    SponsorRecord, SponsorTotals, StripeEvent, TwitterProfile, User
+    BetaProject, CacheGeneration, DonorTotals, ExchangeRates, GitHubProfile,
+    GitHubRepo, Login, SponsorRecord, SponsorRoster, SponsorSlots,
+    StripeEvent, TwitterProfile, User
 )
 
 from weblite import (
-    app, Context, handle, NotFound, Redirect
+    app, Context, FileUpload, get_handler_timings, handle, NotFound,
+    preload_templates, Redirect, TEMPLATE_CACHE
 )
 
 import cloudstorage as gcs
 import stripe
 
+from batch import Batcher, STATS as BATCH_STATS
 from emoji import EMOJI_MAP, EMOJI_SHORTCODES
 from finance import (
     BASE_PRICES, CAMPAIGN_TARGET_FACTOR, PLAN_FACTORS, PLAN_SLOTS,
     TERRITORY2TAX
 )
 
+from generations import bump_generations, get_generation, get_generations
 from gfm import (
     AutolinkExtension, AutomailExtension, SpacedLinkExtension,
     StrikethroughExtension
@@ -59,14 +65,19 @@ from github import Client as GithubClient
 
 from google.appengine.api.images import Image, JPEG, PNG
 from google.appengine.api.memcache import (
-    delete as delete_cache, delete_multi as delete_cache_multi,
-    flush_all, get as get_cache, get_multi as get_cache_multi,
-    set as set_cache, set_multi as set_cache_multi
+    delete as delete_cache, flush_all, get as get_cache,
+    get_multi as get_cache_multi, set as set_cache,
+    set_multi as set_cache_multi
 )
 
+from google.appengine.api.taskqueue import (
+    add as add_task, TaskAlreadyExistsError, TombstonedTaskError
+)
 from google.appengine.api.urlfetch import fetch as urlfetch, POST
 from google.appengine.ext import db
-from google.appengine.ext.db import run_in_transaction
+from google.appengine.ext.db import (
+    create_transaction_options, run_in_transaction, run_in_transaction_options
+)
 
 from markdown import Extension, Markdown
 from markdown.extensions.abbr import AbbrExtension
@@ -79,6 +90,10 @@ from markdown.extensions.tables import TableExtension
 from markdown.extensions.toc import TocExtension
 from markdown.preprocessors import Preprocessor
 from prices import DETAILED_DEFAULT, PRICES_INDEX, PRICES_POS, TERRITORY2PRICES
+from slots import (
+    get_slot_counts, migrate_sponsor_slots, release_expired_reservations,
+    reserve_sponsor_slot, sync_sponsor_slot
+    )
 
 from tavutil.crypto import (
     create_tamper_proof_string, secure_string_comparison,
@@ -86,6 +101,8 @@ from tavutil.crypto import (
 )
 
 from territories import TERRITORIES, TERRITORY_CODES
+from tiercache import TwoTierCache
+from timing import BUCKET_LABELS, get_percentile
 from twitter import Client as TwitterClient
 
 # -----------------------------------------------------------------------------
@@ -101,16 +118,17 @@ AUTH_HANDLERS = frozenset([
 
 CACHE_SPECS = {}
 
-GITHUB_MEMCACHE_KEYS = ['github.repo|gitfund']
 GITHUB_PROFILES = []
-SOCIAL_MEMCACHE_KEYS = GITHUB_MEMCACHE_KEYS[:]
-TWITTER_MEMCACHE_KEYS = []
+SOCIAL_MEMCACHE_KEYS = ['github.repo|gitfund']
 TWITTER_PROFILES = []
 
 README_PNG = '\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x05\x00\x00\x00\x96\x04\x03\x00\x00\x00\xe4\xb3_;\x00\x00\x00\x0fPLTE\xcc\xcc\xcc\xd2\xd2\xd2\xd6\xd6\xd6\xd9\xd9\xd9\xea\xea\xea\x98zvV\x00\x00\x00\x19IDAT(Scp\x16v`P\x00\xc2Q0\n\xa8\x01@i\t\x98\xa6\x00\xf7\xfd\x01\xad\xc4e\xf0\\\x00\x00\x00\x00IEND\xaeB`\x82'
 
 SIMG = "By Markus Spiske: https://unsplash.com/@markusspiske?photo=xekxE_VR0Ec"
 
+SYNC_BATCH_SIZE = 20
+SYNC_TIME_BUDGET = 30
+
 USD_BASE_PRICE = BASE_PRICES['USD'][-1]
 
 VALID_SPONSOR_IMAGE_CONTENT_TYPES = frozenset([
@@ -220,27 +238,107 @@ Context.stripe_js = False
 # Local Cache
 # -----------------------------------------------------------------------------
 
+# A ``CacheSpec`` holds an in-process cached value along with the function that
+# generates it. Only one caller regenerates an expired value at a time, while
+# any others are served the stale value, or wait for it if there isn't one.
+#
+# Expiry times are jittered by up to ``jitter`` of the duration, so that values
+# cached at the same time don't all expire together. If ``refresh_ahead`` is
+# set, the first caller within that many seconds of the expiry regenerates the
+# value early, so that it rarely expires under load. As threads can't outlive
+# requests on App Engine, this happens inline for that one caller.
+#
+# If a spec has a ``generation``, the value is treated as expired as soon as
+# that generation has been bumped. Failures are cached for ``error_duration``
+# seconds, during which the stale value is served if there is one, and the
+# error is raised otherwise.
 class CacheSpec(object):
-    def __init__(self, duration, generator):
+    def __init__(
+        self, duration, generator, generation=None, refresh_ahead=0,
+        jitter=0.1, error_duration=10
+        ):
+        self.cond = Condition()
         self.duration = duration
+        self.error = None
+        self.error_duration = error_duration
+        self.error_expires = 0
+        self.expires = 0
+        self.generation = generation
         self.generator = generator
-        self.lock = allocate_lock()
-        self.timestamp = 0
+        self.jitter = jitter
+        self.loaded = False
+        self.refresh_ahead = refresh_ahead
+        self.refreshing = False
+        self.stats = dict.fromkeys([
+            'errors', 'hits', 'misses', 'refresh_time', 'refreshes',
+            'stale_hits', 'waits'
+            ], 0)
         self.value = None
+        self.version = None
+
+    def regenerate(self, version):
+        cond, stats = self.cond, self.stats
+        start = time()
+        try:
+            value = self.generator()
+        except Exception, err:
+            logging.exception("Couldn't regenerate cached value: %s" % err)
+            with cond:
+                self.error = err
+                self.error_expires = time() + self.error_duration
+                self.refreshing = False
+                stats['errors'] += 1
+                cond.notify_all()
+                if self.loaded:
+                    return self.value
+            raise
+        now = time()
+        with cond:
+            self.error = None
+            self.expires = now + self.duration * (1 - self.jitter * random())
+            self.loaded = True
+            self.refreshing = False
+            self.value = value
+            self.version = version
+            stats['refresh_time'] += now - start
+            stats['refreshes'] += 1
+            cond.notify_all()
+        return value
 
 def get_local(ident, force=False):
-    spec, now = CACHE_SPECS[ident], time()
-    lock = spec.lock
-    lock.acquire()
-    val = spec.value
-    if force or ((now - spec.timestamp) > spec.duration):
-        lock.release()
-        val = spec.generator()
-        lock.acquire()
-        spec.timestamp = now
-        spec.value = val
-    lock.release()
-    return val
+    spec = CACHE_SPECS[ident]
+    if spec.generation:
+        version = get_generation(spec.generation)
+    else:
+        version = None
+    cond, stats = spec.cond, spec.stats
+    with cond:
+        now = time()
+        if not (force or now >= spec.expires or version != spec.version):
+            stats['hits'] += 1
+            if spec.refreshing or not spec.refresh_ahead or (
+                now < (spec.expires - spec.refresh_ahead)
+            ):
+                return spec.value
+        elif spec.refreshing:
+            if spec.loaded:
+                stats['stale_hits'] += 1
+                return spec.value
+            stats['waits'] += 1
+            while spec.refreshing:
+                cond.wait()
+            if spec.loaded:
+                return spec.value
+            raise spec.error
+        elif now < spec.error_expires and not force:
+            if spec.loaded:
+                stats['stale_hits'] += 1
+                return spec.value
+            raise spec.error
+        else:
+            stats['misses'] += 1
+        spec.refreshing = True
+    return spec.regenerate(version)
 
 # -----------------------------------------------------------------------------
 # Local Cache Generator Functions
@@ -251,12 +349,18 @@ Totals = namedtuple(
 )
 
 def get_totals():
-    cache = get_cache_multi(['sponsor.totals', 'donor.totals'])
+    return get_local('totals')
+
+def load_totals():
+    prefix = '%d|' % get_generation('totals')
+    cache = get_cache_multi(
+        ['sponsor.totals', 'donor.totals'], key_prefix=prefix
+    )
     to_set = {}
     if 'sponsor.totals' in cache:
         sponsor_plans = cache['sponsor.totals']
     else:
-        sponsor_plans = SponsorTotals.get_or_insert('gitfund').get_plans()
+        sponsor_plans = get_slot_counts()
         to_set['sponsor.totals'] = sponsor_plans
     backers = raised = 0
     for plan, slots in sponsor_plans.iteritems():
@@ -265,14 +369,10 @@ def get_totals():
     if 'donor.totals' in cache:
         donors = cache['donor.totals']
     else:
-        donors = 0
-        for backer in User.all().filter('backer =', True).filter(
-            'sponsor =', False
-        ).run(batch_size=1000, keys_only=True):
-            donors += 1
+        donors = get_donor_count()
         to_set['donor.totals'] = donors
     if to_set:
-        set_cache_multi(to_set, 20)
+        set_cache_multi(to_set, 300, key_prefix=prefix)
     backers += donors
     raised += donors * PLAN_FACTORS['donor']
     if not raised:
@@ -289,7 +389,8 @@ def get_totals():
 SocialProfiles = namedtuple('SocialProfiles', ['github', 'repo', 'twitter'])
 
 def get_social_profiles():
-    cache = get_cache_multi(SOCIAL_MEMCACHE_KEYS)
+    prefix = '%d|' % get_generation('social')
+    cache = get_cache_multi(SOCIAL_MEMCACHE_KEYS, key_prefix=prefix)
     github = {}
     repo = None
     twitter = {}
@@ -330,30 +431,85 @@ def get_social_profiles():
                     "Received unexpected entity at %r[%d]: %r"
                     % (resp, idx, entity)
                     )
-        set_cache_multi(entries, 300)
+        set_cache_multi(entries, 300, key_prefix=prefix)
     return SocialProfiles(github, repo, twitter)
 
 def get_sponsors():
-    sponsors = get_cache('sponsors')
+    return get_local('sponsors')
+
+# The sponsors are read from the materialized roster, and as the memcache key
+# changes whenever the roster does, the value is cached without an expiry.
+def load_sponsors():
+    key = 'sponsors|%d' % get_generation('sponsors')
+    sponsors = get_cache(key)
     if sponsors:
         return sponsors
+    roster = SponsorRoster.get_by_key_name('gitfund')
+    if not roster:
+        roster = rebuild_sponsor_roster()
     sponsors = {
         'platinum': [],
         'gold': [],
         'silver': [],
         'bronze': [],
     }
-    for sponsor in User.all().filter('sponsor =', True).order(
-        'backing_started'
-        ).run(batch_size=100):
-        sponsors[sponsor.plan].append({
-            'img': sponsor.get_image_spec(),
-            'text': sponsor.get_link_text(),
-            'url': sponsor.get_link_url(),
-        })
-    set_cache('sponsors', sponsors, 20)
+    for entry in sorted(
+        roster.get_sponsors().itervalues(), key=itemgetter('started')
+    ):
+        sponsors[entry['plan']].append(entry)
+    set_cache(key, sponsors)
     return sponsors
 
+# -----------------------------------------------------------------------------
+# Page Cache
+# -----------------------------------------------------------------------------
+
+# Rendered campaign pages for anonymous visitors are cached under keys which
+# include the generations of the data shown on the pages, so that they are
+# implicitly invalidated whenever any of it changes.
+PAGE_CACHE = TwoTierCache('pages', max_entries=200)
+PAGE_GENERATIONS = ['social', 'sponsors', 'totals']
+
+# The sponsors generation is bumped separately, whenever the sponsor roster is
+# updated.
+def invalidate_backer_caches():
+    bump_generations('totals')
+
+# The campaign page only varies by price group and the thanks flag for
+# anonymous visitors, apart from the selected option in the currency switcher,
+# which is patched up by ``select_territory``.
+def get_campaign_page_key(ctx, territory, thanks):
+    if ctx.get_cookie('auth') or ctx.get_cookie('admin'):
+        return
+    generations = get_generations(PAGE_GENERATIONS)
+    return 'campaign|%s|%d|%s' % (
+        TERRITORY2PRICES[territory], bool(thanks),
+        '.'.join(str(generations[name]) for name in PAGE_GENERATIONS)
+    )
+
+def render_campaign_page(ctx, territory, thanks):
+    ctx.shared_render = True
+    try:
+        content = ctx.render_mako_template(
+            'project', social=get_local('social.profiles'),
+            territory=territory, totals=get_totals(), thanks=thanks
+        )
+        page = ctx.render_mako_template('site', content=content)
+    finally:
+        ctx.shared_render = False
+    return page.encode('utf-8'), territory
+
+def select_territory(page, rendered, territory):
+    if territory == rendered:
+        return page
+    return page.replace(
+        '<option value="%s" selected="selected">' % rendered,
+        '<option value="%s">' % rendered, 1
+    ).replace(
+        '<option value="%s">' % territory,
+        '<option value="%s" selected="selected">' % territory, 1
+    )
+
 # -----------------------------------------------------------------------------
 # GitHub API Client and Utility Functions
 # -----------------------------------------------------------------------------
@@ -555,6 +711,9 @@ def get_sponsor_image_data(id, height):
         data = read_file('sponsor.image/' + image_id)
     return image_id, ctype, data
 
+def delete_file(path):
+    gcs.delete(get_gcs_path(path))
+
 def read_file(path):
     f = gcs.open(get_gcs_path(path), 'r')
     data = f.read()
@@ -566,6 +725,57 @@ def write_file(path, data):
     f.write(data)
     f.close()
 
+def write_file_from_stream(path, stream, chunk_size=1 << 18):
+    f = gcs.open(get_gcs_path(path), 'w', options={'x-goog-acl': 'private'})
+    for chunk in iter(lambda: stream.read(chunk_size), ''):
+        f.write(chunk)
+    f.close()
+
+# -----------------------------------------------------------------------------
+# Sponsor Images
+# -----------------------------------------------------------------------------
+
+MAX_SPONSOR_IMAGE_SIZE = 12 << 20
+
+# Save an uploaded sponsor image to GCS and return its image id. The upload is
+# hashed and then streamed to GCS from the spooled file, so that the image data
+# is never held in memory in full.
+def save_sponsor_image(image, chunk_size=1 << 18):
+    if image.size > MAX_SPONSOR_IMAGE_SIZE:
+        return None, "The sponsor image must be less than 12MB."
+    stream = image.file
+    stream.seek(0)
+    header = stream.read(8)
+    if header.startswith('\xff\xd8\xff'):
+        fmt = 'jpeg'
+    elif header.startswith('\x89PNG\r\n\x1a\n'):
+        fmt = 'png'
+    else:
+        return None, "Sorry, only JPEG and PNG images are currently supported."
+    stream.seek(0)
+    hasher = sha256()
+    for chunk in iter(lambda: stream.read(chunk_size), ''):
+        hasher.update(chunk)
+    image_id = b32encode(hasher.digest() + pack('d', time()))
+    path = 'sponsor.image/' + image_id
+    stream.seek(0)
+    write_file_from_stream(path, stream, chunk_size)
+    meta = Image(filename=get_gcs_filename(path))
+    meta.im_feeling_lucky()
+    meta.execute_transforms(
+        parse_source_metadata=True, output_encoding=JPEG, quality=1
+    )
+    width, height = meta.width, meta.height
+    err = None
+    if (width < 300) or (height < 150):
+        err = "Sorry, the image must be at least 300px wide and 150px high."
+    elif (float(width) / height) > 3:
+        err = "Sorry, the width of the image cannot be more than 3 times its height."
+    if err:
+        delete_file(path)
+        return None, err
+    return image_id + '.' + fmt, None
+
 # -----------------------------------------------------------------------------
 # VAT Validation
 # -----------------------------------------------------------------------------
@@ -665,6 +875,119 @@ def validate_vat_id(vat_id, attempts, deadline=20):
         info[key] = child.text
     return info
 
+# -----------------------------------------------------------------------------
+# Sponsor Roster
+# -----------------------------------------------------------------------------
+
+# The ``SponsorRoster`` is a denormalized copy of the info needed to display
+# the sponsors, keyed by user ID. Entries are updated transactionally from the
+# user entity whenever a user's sponsor status or profile may have changed, and
+# the sponsors generation is bumped if the roster actually changed.
+def get_sponsor_entry(user):
+    return {
+        'img': list(user.get_image_spec()),
+        'plan': user.plan,
+        'started': user.backing_started.isoformat(),
+        'text': user.get_link_text(),
+        'url': user.get_link_url(),
+    }
+
+# Build the roster from scratch. This is only needed if the roster doesn't
+# exist yet, as the query is only eventually consistent.
+def rebuild_sponsor_roster():
+    sponsors = {}
+    for user in User.all().filter('sponsor =', True).run(batch_size=100):
+        if user.plan in PLAN_SLOTS:
+            sponsors[str(user.key().id())] = get_sponsor_entry(user)
+    roster = SponsorRoster(key_name='gitfund')
+    roster.set_sponsors(sponsors)
+    roster.put()
+    return roster
+
+def update_sponsor_roster_txn(user_id):
+    roster = SponsorRoster.get_by_key_name('gitfund')
+    if not roster:
+        return False
+    user = User.get_by_id(user_id)
+    if user and user.sponsor and user.plan in PLAN_SLOTS:
+        entry = get_sponsor_entry(user)
+    else:
+        entry = None
+    sponsors = roster.get_sponsors()
+    key = str(user_id)
+    if sponsors.get(key) == entry:
+        return False
+    if entry:
+        sponsors[key] = entry
+    else:
+        del sponsors[key]
+    roster.set_sponsors(sponsors)
+    roster.put()
+    return True
+
+def update_sponsor_roster(user_id):
+    if run_in_transaction_options(
+        XG_TRANSACTION, update_sponsor_roster_txn, user_id
+    ):
+        bump_generations('sponsors')
+
+# -----------------------------------------------------------------------------
+# Donor Counter
+# -----------------------------------------------------------------------------
+
+# The number of donors is kept in a sharded counter, so that it can be read
+# without scanning the users, and updated without contention on one entity.
+# A random shard is adjusted within the same cross-group transaction as the
+# change to a user's backer/sponsor status. The first shard is the original
+# ``DonorTotals`` entity, so that it carries over the last full count.
+DONOR_SHARDS = 8
+
+DONOR_SHARD_KEYS = ['gitfund'] + [
+    'gitfund.%d' % idx for idx in range(1, DONOR_SHARDS)
+]
+
+XG_TRANSACTION = create_transaction_options(xg=True)
+
+# Record the drift seen by ``cron_donors`` on the first shard, and correct the
+# count if it matches the drift seen on the previous run.
+def correct_donor_count_txn(drift):
+    key = DONOR_SHARD_KEYS[0]
+    shard = DonorTotals.get_by_key_name(key)
+    if not shard:
+        shard = DonorTotals(key_name=key)
+    if drift == shard.drift:
+        if not drift:
+            return False
+        shard.count += drift
+        shard.drift = 0
+        shard.put()
+        return True
+    shard.drift = drift
+    shard.put()
+    return False
+
+def get_donor_count():
+    return sum(
+        shard.count for shard in DonorTotals.get_by_key_name(DONOR_SHARD_KEYS)
+        if shard
+    )
+
+def is_donor(user):
+    return bool(user.backer and not user.sponsor)
+
+def track_donor(user, was_donor):
+    delta = is_donor(user) - was_donor
+    if delta:
+        update_donor_count(delta)
+
+def update_donor_count(delta):
+    key = choice(DONOR_SHARD_KEYS)
+    shard = DonorTotals.get_by_key_name(key)
+    if not shard:
+        shard = DonorTotals(key_name=key)
+    shard.count += delta
+    shard.put()
+
 # -----------------------------------------------------------------------------
 # Backing Subscription
 # -----------------------------------------------------------------------------
@@ -675,6 +998,7 @@ def cancel_backing_txn(user_id, totals_need_syncing=True):
     user = User.get_by_id(user_id)
     if not user.backer:
         return user
+    was_donor = is_donor(user)
     user.backer = False
     user.backing_started = None
     user.delinquent = False
@@ -690,8 +1014,11 @@ def cancel_backing_txn(user_id, totals_need_syncing=True):
     user.totals_need_syncing = totals_need_syncing
     user.totals_version += 1
     user.put()
+    track_donor(user, was_donor)
     return user
 
+# Cancel the subscription on Stripe, and return the updated user, along with
+# any error.
 def cancel_stripe_subscription(user_id, sub_id):
     try:
         sub = stripe.Subscription.retrieve(sub_id)
@@ -700,7 +1027,7 @@ def cancel_stripe_subscription(user_id, sub_id):
             "Error retrieving Stripe subscription %s for %s: %r"
             % (sub_id, user_id, e)
         )
-        return "Sorry, there was an error accessing your subscription. Please try again later."
+        return None, "Sorry, there was an error accessing your subscription. Please try again later."
     if sub.status != 'canceled':
         try:
             sub.delete()
@@ -709,14 +1036,19 @@ def cancel_stripe_subscription(user_id, sub_id):
                 "Error cancelling Stripe subscription %s for %s: %r"
                 % (sub.id, user_id, e)
             )
-            return "Sorry, there was an error cancelling your subscription. Please try again later."
+            return None, "Sorry, there was an error cancelling your subscription. Please try again later."
     def txn():
         user = User.get_by_id(user_id)
         if sub_id in user.stripe_needs_cancelling:
             user.stripe_needs_cancelling.remove(sub_id)
             user.put()
-    run_in_transaction(txn)
+        return user
+    return run_in_transaction(txn), None
 
+# Check the status of the user's subscription on Stripe, and return whether
+# the user was updated, along with any error. The given user is the one that
+# ``sync_backer`` has already loaded, so the transaction is skipped unless the
+# status needs updating, or a delinquency email needs to be sent.
 def check_subscription_status(ctx, user, user_id):
     sub_id = user.stripe_subscription
     try:
@@ -726,77 +1058,138 @@ def check_subscription_status(ctx, user, user_id):
             "Error retrieving Stripe subscription %s for %s: %r"
             % (sub_id, user_id, e)
         )
-        return "Sorry, there was an error accessing your subscription. Please try again later."
-    status = sub.status
-    def txn():
-        user = User.get_by_id(user_id)
-        if user.stripe_subscription != sub_id:
-            return user
-        if status == 'active':
-            if user.delinquent:
-                user.delinquent = False
-                user.delinquent_emailed = False
-            if user.stripe_is_unpaid:
-                user.stripe_is_unpaid = False
-        elif status == 'past_due':
-            if not user.delinquent:
-                user.delinquent = True
-                user.delinquent_emailed = False
-            if user.stripe_is_unpaid:
-                user.stripe_is_unpaid = False
-        elif status == 'canceled':
-            user.backer = False
-            user.backing_started = None
-            user.delinquent = False
-            user.delinquent_emailed = False
-            user.payment_type = ''
-            user.plan = ''
-            user.sponsor = False
-            user.stripe_is_unpaid = False
-            user.stripe_needs_updating = False
-            user.stripe_subscription = ''
-            user.totals_need_syncing = True
-            user.totals_version += 1
-        elif status == 'unpaid':
-            user.stripe_is_unpaid = True
-        user.put()
-        return user
-    user = run_in_transaction(txn)
-    if user.delinquent and not user.delinquent_emailed:
+        return False, "Sorry, there was an error accessing your subscription. Please try again later."
+    if not (
+        needs_status_update(user, sub.status) or
+        (user.delinquent and not user.delinquent_emailed)
+    ):
+        return False, None
+    user, send_email = run_in_transaction_options(
+        XG_TRANSACTION, check_subscription_status_txn, user_id, sub_id,
+        sub.status
+    )
+    if send_email:
         authlink = ctx.compute_url('login', 'back.gitfund', email=user.email, existing='1')
         err = ctx.send_email(
             "Payment failure. Please update your card details",
             user.name, user.email, 'delinquent', authlink=authlink
             )
         if err:
-            return err
-        def mark_as_emailed():
-            user = User.get_by_id(user_id)
-            if user.delinquent:
-                user.delinquent_emailed = True
-                user.put()
-        run_in_transaction(mark_as_emailed)
+            def txn():
+                user = User.get_by_id(user_id)
+                if user.delinquent_emailed:
+                    user.delinquent_emailed = False
+                    user.put()
+            run_in_transaction(txn)
+            return True, err
+    return True, None
+
+# The delinquency email is marked as sent within the same transaction as the
+# status update, so that concurrent syncs don't both send it. It is unmarked
+# again if sending fails.
+def check_subscription_status_txn(user_id, sub_id, status):
+    user = update_subscription_status(user_id, sub_id, status)
+    if user.stripe_subscription != sub_id:
+        return user, False
+    if user.delinquent and not user.delinquent_emailed:
+        user.delinquent_emailed = True
+        user.put()
+        return user, True
+    return user, False
 
 def get_stripe_plan(plan, territory):
     idx = PRICES_POS[plan + '-plan-id']
     return PRICES_INDEX[TERRITORY2PRICES[territory]][idx]
 
+# Return a map of subscription IDs to their status for all of the current
+# subscriptions on Stripe, by paging through the subscriptions with each of the
+# given statuses. Canceled subscriptions aren't listed, as they would make up
+# an ever-growing part of the results.
+def get_subscription_statuses(
+    statuses=('active', 'past_due', 'trialing', 'unpaid')
+    ):
+    subs = {}
+    for status in statuses:
+        starting_after = None
+        while 1:
+            if starting_after:
+                page = stripe.Subscription.list(
+                    limit=100, starting_after=starting_after, status=status
+                )
+            else:
+                page = stripe.Subscription.list(limit=100, status=status)
+            for sub in page.data:
+                subs[sub.id] = sub.status
+            if not (page.has_more and page.data):
+                break
+            starting_after = page.data[-1].id
+    return subs
+
 def handle_cancellation(user_id, totals_need_syncing=True):
-    user = run_in_transaction(cancel_backing_txn, user_id, totals_need_syncing)
-    err = handle_stripe_cancellation(user, user_id)
+    user = run_in_transaction_options(
+        XG_TRANSACTION, cancel_backing_txn, user_id, totals_need_syncing
+    )
+    totals_version = user.totals_version
+    user, err = handle_stripe_cancellation(user, user_id)
     if totals_need_syncing:
-        run_in_transaction(
-            sync_totals_txn, str(user_id), '', user.totals_version
-        )
+        sync_sponsor_slot(user_id, '', totals_version)
     return user, err
 
+# Cancel any outstanding subscriptions, and return the user as updated by the
+# cancellations, so that callers don't have to load them again, along with the
+# first error.
 def handle_stripe_cancellation(user, user_id):
     err = None
-    for sub_id in user.stripe_needs_cancelling:
-        stripe_err = cancel_stripe_subscription(user_id, sub_id)
-        if stripe_err and not err:
-            err = stripe_err
-    return err
+    for sub_id in list(user.stripe_needs_cancelling):
+        updated, stripe_err = cancel_stripe_subscription(user_id, sub_id)
+        if stripe_err:
+            if not err:
+                err = stripe_err
+        else:
+            user = updated
+    return user, err
+
+def needs_status_update(user, status):
+    if status == 'active':
+        return user.delinquent or user.stripe_is_unpaid
+    if status == 'past_due':
+        return (not user.delinquent) or user.stripe_is_unpaid
+    if status == 'canceled':
+        return True
+    if status == 'unpaid':
+        return not user.stripe_is_unpaid
+    return False
+
+# Reconcile the status of all subscriptions with Stripe in bulk. Subscriptions
+# which aren't in the listing, e.g. because they've been canceled, are looked
+# up individually. The resulting updates are applied in batches of cross-group
+# transactions, which are kept small enough to stay within the limit on entity
+# groups, including any donor counter shards.
+def reconcile_subscriptions(batch_size=10):
+    statuses = get_subscription_statuses()
+    updates = []
+    for user in User.all().filter('stripe_subscription >', '').run(
+        batch_size=1000
+    ):
+        sub_id = user.stripe_subscription
+        status = statuses.get(sub_id)
+        if status is None:
+            try:
+                status = stripe.Subscription.retrieve(sub_id).status
+            except Exception as e:
+                logging.error(
+                    "Error retrieving Stripe subscription %s for %s: %r"
+                    % (sub_id, user.key().id(), e)
+                )
+                continue
+        if needs_status_update(user, status):
+            updates.append((user.key().id(), sub_id, status))
+    for idx in range(0, len(updates), batch_size):
+        run_in_transaction_options(
+            XG_TRANSACTION, update_subscription_statuses_txn,
+            updates[idx:idx+batch_size]
+        )
+    return updates
 
 def sync_backer(ctx, user, first_time=False):
     err = []
@@ -804,9 +1197,7 @@ def sync_backer(ctx, user, first_time=False):
     # Sync the totals.
     while user.totals_need_syncing:
         totals_version = user.totals_version
-        maxed = run_in_transaction(
-            sync_totals_txn, str(user_id), user.plan, totals_version
-        )
+        maxed = sync_sponsor_slot(user_id, user.plan, totals_version)
         if maxed == 'old.version':
             user = User.get_by_id(user_id)
             continue
@@ -881,9 +1272,10 @@ def sync_backer(ctx, user, first_time=False):
             user = run_in_transaction(txn)
     # Cancel any outstanding subscriptions.
     if user.stripe_needs_cancelling:
-        _err = handle_stripe_cancellation(user, user_id)
+        user, _err = handle_stripe_cancellation(user, user_id)
         if _err:
             err.append(_err)
+    update_sponsor_roster(user_id)
     # Skip the VAT ID and delinquency checks if it is the first time.
     if first_time:
         if err:
@@ -916,9 +1308,11 @@ def sync_backer(ctx, user, first_time=False):
             err.append(_err)
     # Check if the subscription is past_due or has been cancelled.
     if user.stripe_subscription:
-        _err = check_subscription_status(ctx, user, user_id)
+        updated, _err = check_subscription_status(ctx, user, user_id)
         if _err:
             err.append(_err)
+        if updated:
+            update_sponsor_roster(user_id)
     if err:
         logging.error(
             "There were issues syncing backer info for %s: %r"
@@ -926,32 +1320,144 @@ def sync_backer(ctx, user, first_time=False):
         )
     return err
 
-# TODO(tav): It's possible for this to return different results depending on the
-# order of retry.
-def sync_totals_txn(user_id, plan, version):
-    totals = SponsorTotals.get_by_key_name('gitfund')
-    if not totals:
-        totals = SponsorTotals(key_name='gitfund')
-    plans = totals.get_plans()
-    record = SponsorRecord.get_by_key_name(user_id, parent=totals)
-    if not record:
-        record = SponsorRecord(key_name=user_id, parent=totals)
-    if record.version > version:
-        return 'old.version'
-    if record.plan:
-        plans[record.plan] -= 1
-        record.plan = ''
-    maxed = False
-    if plan in PLAN_SLOTS:
-        if plans[plan] >= PLAN_SLOTS[plan]:
-            maxed = True
+# Apply the given subscription status to the user. This needs to be run within
+# a cross-group transaction. If the status comes from a Stripe event, then
+# ``created`` is the time of that event, and the status is only applied if it
+# isn't older than any event that has already been applied. The user can be
+# passed in if it has already been loaded within the transaction.
+def update_subscription_status(user_id, sub_id, status, created=0, user=None):
+    if user is None:
+        user = User.get_by_id(user_id)
+    if user.stripe_subscription != sub_id:
+        return user
+    if created:
+        if created < user.stripe_event_created:
+            return user
+        user.stripe_event_created = created
+    was_donor = is_donor(user)
+    if status == 'active':
+        if user.delinquent:
+            user.delinquent = False
+            user.delinquent_emailed = False
+        if user.stripe_is_unpaid:
+            user.stripe_is_unpaid = False
+    elif status == 'past_due':
+        if not user.delinquent:
+            user.delinquent = True
+            user.delinquent_emailed = False
+        if user.stripe_is_unpaid:
+            user.stripe_is_unpaid = False
+    elif status == 'canceled':
+        user.backer = False
+        user.backing_started = None
+        user.delinquent = False
+        user.delinquent_emailed = False
+        user.payment_type = ''
+        user.plan = ''
+        user.sponsor = False
+        user.stripe_is_unpaid = False
+        user.stripe_needs_updating = False
+        user.stripe_subscription = ''
+        user.totals_need_syncing = True
+        user.totals_version += 1
+    elif status == 'unpaid':
+        user.stripe_is_unpaid = True
+    user.put()
+    track_donor(user, was_donor)
+    return user
+
+def update_subscription_statuses_txn(updates):
+    return [update_subscription_status(*update) for update in updates]
+
+# -----------------------------------------------------------------------------
+# Stripe Events
+# -----------------------------------------------------------------------------
+
+# The subscription status implied by each of the Stripe event types that we
+# process. For subscription updates, the status is taken from the event.
+STRIPE_EVENT_STATUSES = {
+    'customer.subscription.deleted': 'canceled',
+    'customer.subscription.updated': None,
+    'invoice.payment_failed': 'past_due',
+    'invoice.payment_succeeded': 'active',
+}
+
+STRIPE_EVENT_BATCH_SIZE = 20
+STRIPE_EVENT_IGNORED = 2
+STRIPE_EVENT_PENDING = 0
+STRIPE_EVENT_PROCESSED = 1
+STRIPE_EVENT_RETRY_AGE = 900
+STRIPE_EVENT_RETRY_INTERVAL = 60
+STRIPE_EVENT_TIME_BUDGET = 30
+
+# Queue up the processing of pending events. Tasks are named after a window of
+# the given number of seconds, so that bursts of webhooks are handled by a
+# single task.
+def queue_stripe_events(interval=2):
+    window = int(time()) // interval
+    try:
+        add_task(
+            countdown=((window + 1) * interval + 1) - time(),
+            name='stripe-events-%d-%d' % (interval, window),
+            queue_name='stripe', url='/task.stripe.events'
+        )
+    except (TaskAlreadyExistsError, TombstonedTaskError):
+        pass
+
+# Process a pending event, and return the ID of the affected user, if any,
+# along with whether the event was left pending to be retried.
+#
+# Subscriptions are created with the user's ID in their metadata, so the user
+# can be looked up directly for subscription events. Otherwise, the user is
+# found with a query on ``stripe_subscription``, which is only eventually
+# consistent.
+def process_stripe_event(event):
+    status = None
+    sub_id = None
+    user_id = None
+    if event.event_type in STRIPE_EVENT_STATUSES:
+        obj = decode_json(event.data)['data']['object']
+        if event.event_type.startswith('customer.subscription.'):
+            sub_id = obj['id']
+            status = STRIPE_EVENT_STATUSES[event.event_type] or obj['status']
+            user_id = (obj.get('metadata') or {}).get('user_id')
         else:
-            record.plan = plan
-            plans[plan] += 1
-    record.version = version
-    totals.set_plans(plans)
-    db.put([totals, record])
-    return maxed
+            sub_id = obj.get('subscription')
+            status = STRIPE_EVENT_STATUSES[event.event_type]
+    if user_id:
+        user_id = int(user_id)
+    elif sub_id:
+        user = User.all(keys_only=True).filter(
+            'stripe_subscription =', sub_id
+        ).get()
+        if user:
+            user_id = user.id()
+    return run_in_transaction_options(
+        XG_TRANSACTION, process_stripe_event_txn, event.key(), user_id,
+        sub_id, status
+    )
+
+# Events which can't be matched to a user's current subscription are left
+# pending until they are ``STRIPE_EVENT_RETRY_AGE`` seconds old, as they may
+# have arrived before the subscription ID was saved, or before the query index
+# caught up with it.
+def process_stripe_event_txn(event_key, user_id, sub_id, status):
+    event = StripeEvent.get(event_key)
+    if event.state != STRIPE_EVENT_PENDING:
+        return None, False
+    user = user_id and User.get_by_id(user_id)
+    if user and user.stripe_subscription == sub_id:
+        update_subscription_status(
+            user_id, sub_id, status, event.created, user
+        )
+        event.state = STRIPE_EVENT_PROCESSED
+    elif sub_id and (time() - event.created) < STRIPE_EVENT_RETRY_AGE:
+        return None, True
+    else:
+        event.state = STRIPE_EVENT_IGNORED
+        user_id = None
+    event.put()
+    return user_id, False
 
 # -----------------------------------------------------------------------------
 # Other Utility Functions
@@ -1240,16 +1746,14 @@ def back_gitfund(
         except Exception as e:
             logging.error("Error adding card to Stripe customer %s: %r" % (user.stripe_customer_id, e))
             return error(STRIPE_ERROR)
-    # Check that a sponsorship slot is available.
+    # Reserve a sponsorship slot, which is confirmed when the totals are synced.
     if plan != user.plan and plan in PLAN_SLOTS:
-        slots = PLAN_SLOTS[plan]
-        totals = SponsorTotals.get_by_key_name('gitfund') # COST(1)
-        plans = totals.get_plans()
-        if plans[plan] >= slots:
+        if not reserve_sponsor_slot(user_id, plan):
             return error("Sorry, there are no %s sponsorship slots left." % plan.title())
     # Set up or update sponsorship.
     def txn():
         user = User.get_by_id(user_id)
+        was_donor = is_donor(user)
         user.payment_type = 'stripe'
         first_time = False
         if not user.backer:
@@ -1297,13 +1801,14 @@ def back_gitfund(
             user.tax_id_is_invalid = False
         user.territory = territory
         user.put()
+        track_donor(user, was_donor)
         return user, first_time
-    user, first_time = run_in_transaction(txn) # COST(1)
+    user, first_time = run_in_transaction_options(XG_TRANSACTION, txn) # COST(1)
     ctx._user = user
     err = sync_backer(ctx, user, first_time)
     if err:
         return error(err[0])
-    delete_cache_multi(['sponsors', 'sponsor.totals', 'donor.totals'])
+    invalidate_backer_caches()
     if user.sponsor and (not user.link_text) and (not user.link_url):
         raise Redirect('/update.sponsor.profile?setup=1')
     if first_time:
@@ -1323,13 +1828,14 @@ def cancel_subscription(ctx, xsrf=None):
             'backer': user
         }
     ctx.validate_xsrf(xsrf)
-    user, err = handle_cancellation(ctx.user_id)
-    if err:
-        return {'error': err}
+    # The slot and the Stripe subscription are released by ``sync_backer``.
+    user = run_in_transaction_options(
+        XG_TRANSACTION, cancel_backing_txn, ctx.user_id
+    )
     err = sync_backer(ctx, user)
     if err:
         return {'error': err}
-    delete_cache_multi(['sponsors', 'sponsor.totals', 'donor.totals'])
+    invalidate_backer_caches()
     return {'cancelled': True}
 
 @handle(['community', 'site'])
@@ -1361,6 +1867,31 @@ def community(ctx, email=None, xsrf=''):
         return {'error': "Sorry, there was an unexpected error. Please try again later."}
     return {'sent': True}
 
+# The cache stats are for the current instance only.
+@handle(admin=True)
+def cache_stats(ctx):
+    ctx.response_headers['Content-Type'] = 'text/plain'
+    lines = []
+    for prefix, cache in [('page', PAGE_CACHE), ('template', TEMPLATE_CACHE)]:
+        for item in sorted(cache.stats.items()):
+            lines.append("%s.%s\t\t%d" % ((prefix,) + item))
+    for ident, spec in sorted(CACHE_SPECS.items()):
+        stats = spec.stats
+        for key, value in sorted(stats.items()):
+            if key != 'refresh_time':
+                lines.append("local.%s.%s\t\t%d" % (ident, key, value))
+        if stats['refreshes']:
+            lines.append("local.%s.refresh_ms\t\t%.2f" % (
+                ident, stats['refresh_time'] * 1000 / stats['refreshes']
+            ))
+    for item in sorted(BATCH_STATS.items()):
+        lines.append("batch.%s\t\t%d" % item)
+    lines.append("batch.rpcs_saved\t\t%d" % (
+        BATCH_STATS['deletes'] + BATCH_STATS['gets'] + BATCH_STATS['puts'] -
+        BATCH_STATS['rpcs']
+    ))
+    return '\n'.join(lines)
+
 @handle(admin=True)
 def compare_currencies(ctx):
     rates = decode_json(
@@ -1380,6 +1911,11 @@ def compare_currencies(ctx):
     hdr = 'Symbol\t\tRatio\t\tCurrent\t\tPreset\n\n'
     return hdr + '\n'.join("%s\t\t%s%17s%15s" % row for row in data)
 
+# Reconcile the sharded donor counter with a full count of the donors. The
+# count comes from an eventually consistent query, and can race with updates
+# to the counter, so a mismatch is only corrected once the same drift has been
+# seen on two consecutive runs. The correction is applied to a shard, so that
+# concurrent updates to the counter aren't lost.
 @handle
 def cron_donors(ctx):
     count = 0
@@ -1387,34 +1923,42 @@ def cron_donors(ctx):
         'sponsor =', False
     ).run(batch_size=1000, keys_only=True):
         count += 1
-    totals = DonorTotals.get_or_insert('gitfund')
-    totals.count = count
-    totals.put()
-    delete_cache('donor.totals')
+    drift = count - get_donor_count()
+    if drift:
+        logging.warn("Donor count is off by %d" % drift)
+    if run_in_transaction(correct_donor_count_txn, drift):
+        logging.warn("Corrected donor count by %d" % drift)
+        bump_generations('totals')
     return 'OK'
 
 @handle
 def cron_github(ctx):
-    for username in GITHUB_PROFILES:
-        profile = GitHubProfile.get_by_key_name(username)
-        if not profile:
-            profile = GitHubProfile(key_name=username)
-        info = github.users(username).get()
-        profile.avatar = info['avatar_url']
-        if info['bio']:
-            profile.description = info['bio']
-        profile.followers = info['followers']
-        profile.joined = strptime(info['created_at'], '%Y-%m-%dT%H:%M:%SZ')
-        if info['name']:
-            profile.name = info['name']
-        profile.put()
-    repo = GitHubRepo.get_by_key_name('gitfund')
-    if not repo:
-        repo = GitHubRepo(key_name='gitfund')
-    info = github.repos.tav.gitfund.get()
-    repo.stars = info['stargazers_count']
-    repo.put()
-    delete_cache_multi(GITHUB_MEMCACHE_KEYS)
+    with Batcher() as batch:
+        profiles = [
+            (username, batch.get(create_key('GitHubProfile', username)))
+            for username in GITHUB_PROFILES
+        ]
+        repo = batch.get(create_key('GitHubRepo', 'gitfund'))
+        for username, profile in profiles:
+            profile = profile.get_result()
+            if not profile:
+                profile = GitHubProfile(key_name=username)
+            info = github.users(username).get()
+            profile.avatar = info['avatar_url']
+            if info['bio']:
+                profile.description = info['bio']
+            profile.followers = info['followers']
+            profile.joined = strptime(info['created_at'], '%Y-%m-%dT%H:%M:%SZ')
+            if info['name']:
+                profile.name = info['name']
+            batch.put(profile)
+        repo = repo.get_result()
+        if not repo:
+            repo = GitHubRepo(key_name='gitfund')
+        info = github.repos.tav.gitfund.get()
+        repo.stars = info['stargazers_count']
+        batch.put(repo)
+    bump_generations('social')
     return 'OK'
 
 @handle
@@ -1438,27 +1982,61 @@ def cron_fxrates(ctx):
         logging.exception("Couldn't fetch exchange rates: %s" % err)
     return 'OK'
 
+# Release any slot reservations that were never confirmed, e.g. because the
+# checkout failed part way through. This also finishes migrating the slots
+# from the original ``SponsorTotals`` entity group, which is otherwise done
+# by the first request to touch the slots on each instance.
 @handle
-def cron_sync(ctx):
-    for user in User.all().filter(
-        'updated <=', datetime.utcnow() - timedelta(minutes=10)
-    ).order('updated'):
-        sync_backer(ctx, user)
+def cron_slots(ctx):
+    migrated = migrate_sponsor_slots()
+    if migrated:
+        logging.info("Migrated %d sponsor records" % migrated)
+    released = release_expired_reservations()
+    if released:
+        logging.info("Released %d sponsor slot reservations" % released)
+    return 'OK'
+
+# Any users that need further work, e.g. delinquency emails or syncing the
+# totals after a cancellation, are flagged with ``needs_sync`` and are picked
+# up by ``cron_sync``.
+@handle
+def cron_subscriptions(ctx):
+    updates = reconcile_subscriptions()
+    if updates:
+        logging.info("Updated %d subscription statuses" % len(updates))
+        invalidate_backer_caches()
+    return 'OK'
+
+# Fan out the users with pending sync work to ``task.sync`` in batches. If
+# ``full`` is set, e.g. to pick up users saved before ``needs_sync`` existed,
+# all users are fanned out instead.
+@handle
+def cron_sync(ctx, full=''):
+    dispatch_sync(None, full)
+    # Pick up any Stripe events which were missed, e.g. because queueing the
+    # task failed.
+    add_task(queue_name='stripe', url='/task.stripe.events')
+    return 'OK'
 
 @handle
 def cron_twitter(ctx):
-    for screen_name in TWITTER_PROFILES:
-        profile = TwitterProfile.get_by_key_name(screen_name)
-        if not profile:
-            profile = TwitterProfile(key_name=screen_name)
-        info = twitter.users.show(screen_name=screen_name, include_entities=False)
-        profile.avatar = info['profile_image_url_https']
-        profile.description = info['description']
-        profile.followers = info['followers_count']
-        profile.joined = datetime.strptime(info['created_at'], '%a %b %d %H:%M:%S +0000 %Y')
-        profile.name = info['name']
-        profile.put()
-    delete_cache_multi(TWITTER_MEMCACHE_KEYS)
+    with Batcher() as batch:
+        profiles = [
+            (screen_name, batch.get(create_key('TwitterProfile', screen_name)))
+            for screen_name in TWITTER_PROFILES
+        ]
+        for screen_name, profile in profiles:
+            profile = profile.get_result()
+            if not profile:
+                profile = TwitterProfile(key_name=screen_name)
+            info = twitter.users.show(screen_name=screen_name, include_entities=False)
+            profile.avatar = info['profile_image_url_https']
+            profile.description = info['description']
+            profile.followers = info['followers_count']
+            profile.joined = datetime.strptime(info['created_at'], '%a %b %d %H:%M:%S +0000 %Y')
+            profile.name = info['name']
+            batch.put(profile)
+    bump_generations('social')
     return 'OK'
 
 @handle(['get.funded', 'site'])
@@ -1539,11 +2117,40 @@ def logout(ctx):
     ctx.expire_cookie('admin')
     raise Redirect('/')
 
+def dispatch_sync(cursor, full):
+    start = time()
+    if full:
+        query = User.all(keys_only=True)
+    else:
+        query = User.all(keys_only=True).filter('needs_sync =', True)
+    while 1:
+        if cursor:
+            query.with_cursor(cursor)
+        keys = query.fetch(SYNC_BATCH_SIZE)
+        if not keys:
+            break
+        add_task(
+            url='/task.sync', params={
+                'ids': ','.join(str(key.id()) for key in keys)
+            }, queue_name='sync'
+        )
+        if len(keys) < SYNC_BATCH_SIZE:
+            break
+        cursor = query.cursor()
+        # Carry on in a new task if we've run out of time.
+        if (time() - start) > SYNC_TIME_BUDGET:
+            add_task(
+                url='/task.sync.dispatch', params={
+                    'cursor': cursor, 'full': full
+                }, queue_name='sync'
+            )
+            break
+
 @handle(['manage.subscription', 'site'], anon=False)
 def manage_subscription(ctx):
     ctx.page_title = "Manage Subscription"
 
-@handle(['manual.sponsor', 'site'], admin=True)
+@handle(['manual.sponsor', 'site'], admin=True, max_body_size=16 << 20)
 def manual_sponsor(
     ctx, name='', email='', plan='', link='', image=None, xsrf=None
     ):
@@ -1581,33 +2188,19 @@ def manual_sponsor(
         user.sponsor = True
         user.totals_need_syncing = True
         user.totals_version += 1
-    if hasattr(image, 'file'):
-        data = image.value
-        if data and len(data) > (12 << 20):
-            return error("The sponsor image must be less than 12MB.")
-        if data.startswith('\xff\xd8\xff'):
-            fmt = 'jpeg'
-        elif data.startswith('\x89PNG\r\n\x1a\n'):
-            fmt = 'png'
-        else:
-            return error("Sorry, only JPEG and PNG images are currently supported.")
-        meta = Image(data)
-        meta.im_feeling_lucky()
-        meta.execute_transforms(
-            parse_source_metadata=True, output_encoding=JPEG, quality=1
-        )
-        width, height = meta.width, meta.height
-        if (width < 300) or (height < 150):
-            return error("Sorry, the image must be at least 300px wide and 150px high.")
-        if (float(width) / height) > 3:
-            return error("Sorry, the width of the image cannot be more than 3 times its height.")
-        image_id = b32encode(sha256(data).digest() + pack('d', time()))
-        write_file('sponsor.image/' + image_id, data)
-        user.image_id = image_id + '.' + fmt
-    user.put()
+    if isinstance(image, FileUpload):
+        image_id, err = save_sponsor_image(image)
+        if err:
+            return error(err)
+        user.image_id = image_id
+    def txn():
+        was_donor = is_donor(User.get_by_id(user.key().id()))
+        user.put()
+        track_donor(user, was_donor)
+    run_in_transaction_options(XG_TRANSACTION, txn)
     if plan != 'donor':
         sync_backer(ctx, user, first_time=True)
-    delete_cache_multi(['sponsors', 'sponsor.totals', 'donor.totals'])
+    invalidate_backer_caches()
     return {'created': True}
 
 @handle
@@ -1690,57 +2283,132 @@ def site_sponsors(ctx, cursor=None, thanks=None):
         'thanks': thanks,
     }
 
-@handle
+# Sponsor image ids are immutable and end with the packed upload time, so the
+# response can be validated without reading the image from GCS.
+def get_sponsor_image_validator(ctx, id, height=None):
+    try:
+        created = unpack('d', b32decode(id.split('.', 1)[0])[-8:])[0]
+    except Exception:
+        created = None
+    return '%s.%s' % (id, height or ''), created
+
+@handle(cache=('public', 3600), validate=get_sponsor_image_validator)
 def sponsor_image(ctx, id, height=None):
     try:
         image_id, ctype, data = get_sponsor_image_data(id, height)
     except:
         raise NotFound
     ctx.response_headers['Content-Type'] = ctype
-    ctx.cache_response(image_id, 3600)
     return data
 
 @handle
 def static_file(ctx, *path):
     raise Redirect(ctx.STATIC('/'.join(path)))
 
-@handle
-def stripe_webhook(ctx, token, **kwargs):
+# The event is stored exactly as Stripe sent it, so that the body doesn't have
+# to be re-encoded. Only the fields that are indexed are read out of it.
+@handle(raw_body=True)
+def stripe_webhook(ctx, token):
     if not secure_string_comparison(token, STRIPE_WEBHOOK_TOKEN):
         raise NotFound
-    customer = ''
-    if 'data' in kwargs:
-        data = kwargs['data']
-        if 'object' in data:
-            obj = data['object']
-            if 'customer' in obj:
-                cus = obj['customer']
-                if cus:
-                    customer = cus
+    event = ctx.request_json
+    customer = event.get('data', {}).get('object', {}).get('customer')
     StripeEvent.get_or_insert(
-        kwargs.pop('id'), created=kwargs.pop('created'), customer=customer,
-        event_type=kwargs.pop('type'), livemode=kwargs.pop('livemode'),
-        data=encode_json(kwargs)
+        event['id'], created=event['created'], customer=customer or '',
+        event_type=event['type'], livemode=event['livemode'],
+        data=ctx.request_body
     )
+    queue_stripe_events()
+    return 'OK'
+
+# Process the pending Stripe events in the order they were created. Users who
+# were affected by an event are synced straight away, e.g. to send delinquency
+# emails, or to update the totals after a cancellation.
+@handle
+def task_stripe_events(ctx):
+    start = time()
+    query = StripeEvent.all().filter(
+        'state =', STRIPE_EVENT_PENDING
+    ).order('created')
+    user_ids = set()
+    retry = False
+    while 1:
+        events = query.fetch(STRIPE_EVENT_BATCH_SIZE)
+        for event in events:
+            user_id, pending = process_stripe_event(event)
+            if user_id:
+                user_ids.add(user_id)
+            if pending:
+                retry = True
+        if len(events) < STRIPE_EVENT_BATCH_SIZE:
+            break
+        # Carry on in a new task if we've run out of time.
+        if (time() - start) > STRIPE_EVENT_TIME_BUDGET:
+            add_task(queue_name='stripe', url='/task.stripe.events')
+            break
+        query.with_cursor(query.cursor())
+    # Events which couldn't be matched to a user yet are tried again shortly.
+    if retry:
+        queue_stripe_events(STRIPE_EVENT_RETRY_INTERVAL)
+    for user_id in user_ids:
+        user = User.get_by_id(user_id)
+        if user.needs_sync:
+            sync_backer(ctx, user)
+    if user_ids:
+        invalidate_backer_caches()
+    return 'OK'
+
+# Users who were changed recently are skipped, as they are likely to still be
+# synced inline by the handler that changed them.
+@handle
+def task_sync(ctx, ids=''):
+    cutoff = datetime.utcnow() - timedelta(minutes=10)
+    synced = False
+    for user_id in filter(None, ids.split(',')):
+        user = User.get_by_id(int(user_id))
+        if not (user and user.needs_sync):
+            continue
+        if user.updated > cutoff:
+            continue
+        sync_backer(ctx, user)
+        synced = True
+    if synced:
+        invalidate_backer_caches()
+    return 'OK'
+
+@handle
+def task_sync_dispatch(ctx, cursor=None, full=''):
+    dispatch_sync(cursor, full)
     return 'OK'
 
-@handle(['project', 'site'])
-def tav(ctx, project='', thanks=None, **kwargs):
-    if project != 'gitfund':
+@handle('/<owner>/<project>', ['project', 'site'])
+def tav(ctx, owner, project, thanks=None, **kwargs):
+    if owner != 'tav' or project != 'gitfund':
         raise NotFound
     ctx.show_sponsors_footer = True
     ctx.site_description = CAMPAIGN_DESCRIPTION
     ctx.site_image = ctx.site_url + ctx.STATIC("gfx/cover.lossy.jpeg")
     ctx.site_image_attribution = SIMG
     ctx.site_title = CAMPAIGN_TITLE
+    territory = ctx.get_territory()
+    key = get_campaign_page_key(ctx, territory, thanks)
+    if key:
+        page, rendered = PAGE_CACHE.get_or_create(
+            key, lambda: render_campaign_page(ctx, territory, bool(thanks))
+        )
+        ctx.compress_key = key + '|' + territory
+        ctx.end_pipeline = True
+        return select_territory(page, rendered, territory)
     return {
         'social': get_local('social.profiles'),
-        'territory': ctx.get_territory(),
+        'territory': territory,
         'totals': get_totals(),
         'thanks': thanks,
     }
 
-@handle(['update.sponsor.profile', 'site'], anon=False)
+@handle(
+    ['update.sponsor.profile', 'site'], anon=False, max_body_size=16 << 20
+)
 def update_sponsor_profile(
     ctx, link_text='', link_url='', image=None, setup='', xsrf=None
     ):
@@ -1767,34 +2435,16 @@ def update_sponsor_profile(
         if len(link_url.encode('utf-8')) > 500:
             return error("The link URL must be less than 500 bytes long.")
     image_id = ''
-    if hasattr(image, 'file'):
-        data = image.value
-        if data and len(data) > (12 << 20):
-            return error("The sponsor image must be less than 12MB.")
-        if data.startswith('\xff\xd8\xff'):
-            fmt = 'jpeg'
-        elif data.startswith('\x89PNG\r\n\x1a\n'):
-            fmt = 'png'
-        else:
-            return error("Sorry, only JPEG and PNG images are currently supported.")
-        meta = Image(data)
-        meta.im_feeling_lucky()
-        meta.execute_transforms(
-            parse_source_metadata=True, output_encoding=JPEG, quality=1
-        )
-        width, height = meta.width, meta.height
-        if (width < 300) or (height < 150):
-            return error("Sorry, the image must be at least 300px wide and 150px high.")
-        if (float(width) / height) > 3:
-            return error("Sorry, the width of the image cannot be more than 3 times its height.")
-        image_id = b32encode(sha256(data).digest() + pack('d', time()))
-        write_file('sponsor.image/' + image_id, data)
+    if isinstance(image, FileUpload):
+        image_id, err = save_sponsor_image(image)
+        if err:
+            return error(err)
     def txn():
         user = User.get_by_id(ctx.user_id)
         user.link_text = link_text
         user.link_url = link_url
         if image_id:
-            user.image_id = image_id + '.' + fmt
+            user.image_id = image_id
         user.put()
         return user
     ctx.log({
@@ -1804,7 +2454,7 @@ def update_sponsor_profile(
         "user_id": ctx.user_id,
     })
     run_in_transaction(txn)
-    delete_cache('sponsors')
+    update_sponsor_roster(ctx.user_id)
     raise Redirect('/site.sponsors?thanks=1')
 
 @handle(['users.list', 'site'])
@@ -1829,6 +2479,74 @@ def users_list(ctx, cursor=None):
         'users': users,
     }
 
+# List the handler phases by their aggregated 95th percentile, so that the
+# slowest handlers are at the top.
+@handle(admin=True)
+def timings(ctx):
+    data = []
+    for (handler, phase), counts in get_handler_timings().iteritems():
+        total = sum(counts[:-1])
+        data.append((
+            get_percentile(counts, 95), counts[-1] / float(total), total,
+            handler, phase, ' '.join(
+                '%s:%d' % (label, count)
+                for label, count in zip(BUCKET_LABELS, counts) if count
+            )
+        ))
+    data.sort(reverse=True)
+    ctx.response_headers['Content-Type'] = 'text/plain'
+    hdr = 'p95\t\tMean\t\tCount\t\tHandler/Phase\n\n'
+    return hdr + '\n'.join(
+        "%sms\t\t%.1fms\t\t%s\t\t%s/%s\n\t\t%s" % row for row in data
+    )
+
+@handle(admin=True)
+def users_export(ctx):
+    ctx.response_headers['Content-Type'] = 'text/csv; charset=utf-8'
+    ctx.response_headers['Content-Disposition'] = 'attachment; filename="users.csv"'
+    return iter_users_csv()
+
+USERS_EXPORT_FIELDS = [
+    'id', 'name', 'email', 'backer', 'sponsor', 'plan', 'payment_type',
+    'territory', 'delinquent', 'stripe_customer_id', 'stripe_subscription',
+    'backing_started', 'created', 'updated'
+]
+
+# Cells starting with these characters are run as formulas by spreadsheets.
+CSV_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+# Stream the users out in batches, so that memory use stays flat regardless of
+# the number of users. User-controlled values which could be run as formulas
+# when the export is opened in a spreadsheet are prefixed with a quote.
+def iter_users_csv(batch_size=200):
+    buf = StringIO()
+    out = csv_writer(buf)
+    out.writerow(USERS_EXPORT_FIELDS)
+    count = 0
+    for user in User.all().order('created').run(batch_size=batch_size):
+        row = []; append = row.append
+        for field in USERS_EXPORT_FIELDS:
+            if field == 'id':
+                value = user.key().id()
+            else:
+                value = getattr(user, field)
+            if value is None:
+                value = ''
+            elif isinstance(value, basestring):
+                if isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                if value.startswith(CSV_FORMULA_PREFIXES):
+                    value = "'" + value
+            append(value)
+        out.writerow(row)
+        count += 1
+        if count == batch_size:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            count = 0
+    yield buf.getvalue()
+
 @handle(admin=True)
 def validate_vat(ctx, vat_id):
     ctx.log({"vat_id": vat_id})
@@ -1840,6 +2558,13 @@ def validate_vat(ctx, vat_id):
         return "ERROR: " + resp
     return resp
 
+# App Engine sends warmup requests to new instances before routing any user
+# requests to them.
+@handle('/_ah/warmup', ssl=False)
+def warmup(ctx):
+    preload_templates()
+    return 'OK'
+
 # ------------------------------------------------------------------------------
 # Dev Handlers
 # ------------------------------------------------------------------------------
@@ -1873,12 +2598,13 @@ if not LIVE:
             return xsrf_url(ctx)
         ctx.validate_xsrf(xsrf)
         for model in [
-            BetaProject, DonorTotals, ExchangeRates, GitHubProfile, GitHubRepo,
-            Login, SponsorRecord, SponsorTotals, StripeEvent, TwitterProfile,
-            User
+            BetaProject, CacheGeneration, DonorTotals, ExchangeRates,
+            GitHubProfile, GitHubRepo, Login, SponsorRecord, SponsorRoster,
+            SponsorSlots, StripeEvent, TwitterProfile, User
         ]:
-            for entity in model.all():
-                db.delete(entity)
+            with Batcher() as batch:
+                for key in model.all(keys_only=True):
+                    batch.delete(key)
         flush_all()
         ctx.expire_cookie('auth')
         raise Redirect('/site.bootstrap')
@@ -1889,10 +2615,14 @@ if not LIVE:
 
 def init_state():
 
-    for ident, duration, generator in [
-        ('social.profiles', 300, get_social_profiles),
+    for ident, duration, generator, generation in [
+        ('social.profiles', 300, get_social_profiles, 'social'),
+        ('sponsors', 60, load_sponsors, 'sponsors'),
+        ('totals', 60, load_totals, 'totals'),
     ]:
-        CACHE_SPECS[ident] = CacheSpec(duration, generator)
+        CACHE_SPECS[ident] = CacheSpec(
+            duration, generator, generation, refresh_ahead=duration // 10
+        )
 
     for spec in CAMPAIGN_TEAM:
         if spec.github:
@@ -1901,13 +2631,10 @@ def init_state():
             TWITTER_PROFILES.append(spec.twitter)
 
     for profile in GITHUB_PROFILES:
-        GITHUB_MEMCACHE_KEYS.append('github|%s' % profile)
+        SOCIAL_MEMCACHE_KEYS.append('github|%s' % profile)
 
     for profile in TWITTER_PROFILES:
-        TWITTER_MEMCACHE_KEYS.append('twitter|%s' % profile)
-
-    SOCIAL_MEMCACHE_KEYS.extend(GITHUB_MEMCACHE_KEYS)
-    SOCIAL_MEMCACHE_KEYS.extend(TWITTER_MEMCACHE_KEYS)
+        SOCIAL_MEMCACHE_KEYS.append('twitter|%s' % profile)
 
     for plan, description in PLAN_DESCRIPTIONS.items():
         PLAN_DESCRIPTIONS[plan] = render_markdown(description.strip())
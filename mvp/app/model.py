@@ -15,9 +15,14 @@ class BetaProject(db.Model): # key=<project_id>
     name = db.TextProperty(default=u'')
     url = db.TextProperty(default=u'')
 
-class DonorTotals(db.Model): # key=<project_id>
+class CacheGeneration(db.Model): # key=<generation_name>
+    v = db.IntegerProperty(default=0)
+    value = db.IntegerProperty(default=0, indexed=False)
+
+class DonorTotals(db.Model): # key=<project_id>[.<shard>]
     v = db.IntegerProperty(default=0)
     count = db.IntegerProperty(default=0)
+    drift = db.IntegerProperty(default=0, indexed=False)
 
 class ExchangeRates(db.Model): # key='latest'
     v = db.IntegerProperty(default=0)
@@ -49,24 +54,33 @@ class StripeEvent(db.Model): # key=<stripe_event_id>
     data = db.BlobProperty(default='')
     event_type = db.StringProperty(default='')
     livemode = db.BooleanProperty(default=False)
-    state = db.IntegerProperty(default=0)
+    state = db.IntegerProperty(default=0)                            # 0=pending | 1=processed | 2=ignored
 
-class SponsorRecord(db.Model): # key=<user_id>, parent=<ST:project_id>
+class SponsorRecord(db.Model): # key=<user_id>
     v = db.IntegerProperty(default=0)
     plan = db.StringProperty(default='', indexed=False)
+    reserved = db.StringProperty(default='', indexed=False)
+    reserved_expires = db.IntegerProperty(default=0)
+    reserved_shard = db.IntegerProperty(default=0, indexed=False)
+    shard = db.IntegerProperty(default=0, indexed=False)
     version = db.IntegerProperty(default=0, indexed=False)
 
-class SponsorTotals(db.Model): # key=<project_id>
+class SponsorRoster(db.Model): # key=<project_id>
     v = db.IntegerProperty(default=0)
-    plans = db.TextProperty(default='')
+    sponsors = db.TextProperty(default='')
 
-    def get_plans(self):
-        if not self.plans:
-            return {'bronze': 0, 'silver': 0, 'gold': 0, 'platinum': 0}
-        return decode_json(self.plans)
+    def get_sponsors(self):
+        if not self.sponsors:
+            return {}
+        return decode_json(self.sponsors)
 
-    def set_plans(self, plans):
-        self.plans = encode_json(plans)
+    def set_sponsors(self, sponsors):
+        self.sponsors = encode_json(sponsors)
+
+class SponsorSlots(db.Model): # key=<project_id>.<plan>.<shard>
+    v = db.IntegerProperty(default=0)
+    confirmed = db.IntegerProperty(default=0, indexed=False)
+    reserved = db.IntegerProperty(default=0, indexed=False)
 
 class TwitterProfile(db.Model): # key=<twitter_screen_name>
     v = db.IntegerProperty(default=0)
@@ -90,10 +104,12 @@ class User(db.Model): # key=<auto>
     link_text = db.StringProperty(default='', indexed=False)
     link_url = db.StringProperty(default='', indexed=False)
     name = db.StringProperty(default='', indexed=False)
+    needs_sync = db.BooleanProperty(default=False)
     payment_type = db.StringProperty(default='')                     # 'stripe' | 'manual'
     plan = db.StringProperty(default='')
     sponsor = db.BooleanProperty(default=False)
     stripe_customer_id = db.StringProperty(default='', indexed=False)
+    stripe_event_created = db.IntegerProperty(default=0, indexed=False)
     stripe_is_unpaid = db.BooleanProperty(default=False)
     stripe_needs_cancelling = db.ListProperty(str, indexed=False)
     stripe_needs_updating = db.BooleanProperty(default=False)
@@ -130,4 +146,19 @@ class User(db.Model): # key=<auto>
         return 'sub.%s.%s' % (self.key().id(), self.stripe_update_version)
 
     def get_stripe_meta(self):
-        return {"version": str(self.stripe_update_version)}
+        return {
+            "user_id": str(self.key().id()),
+            "version": str(self.stripe_update_version),
+        }
+
+    # The ``needs_sync`` flag is derived from the other fields on every put, so
+    # that users with pending sync work can be queried for, without having to
+    # set it everywhere that those fields are changed. Note that it isn't set
+    # for users that are saved via ``db.put``.
+    def put(self, **kwargs):
+        self.needs_sync = bool(
+            self.totals_need_syncing or self.stripe_needs_updating or
+            self.stripe_needs_cancelling or self.tax_id_to_validate or
+            (self.delinquent and not self.delinquent_emailed)
+        )
+        return super(User, self).put(**kwargs)
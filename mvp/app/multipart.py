@@ -0,0 +1,213 @@
+# Public Domain (-) 2017 The GitFund Authors.
+# See the GitFund UNLICENSE file for details.
+
+"""Incremental parsers for POST request bodies."""
+
+from cgi import FieldStorage, parse_header, valid_boundary
+from cStringIO import StringIO
+from tempfile import SpooledTemporaryFile
+from urldecode import iter_form_pairs
+
+# ------------------------------------------------------------------------------
+# Constants
+# ------------------------------------------------------------------------------
+
+CHUNK_SIZE = 64 << 10
+MAX_HEADER_SIZE = 8 << 10
+SPOOL_SIZE = 256 << 10
+
+# ------------------------------------------------------------------------------
+# Exceptions
+# ------------------------------------------------------------------------------
+
+# The ``ParseError`` is raised for malformed or truncated request bodies.
+class ParseError(ValueError):
+    pass
+
+# ------------------------------------------------------------------------------
+# File Uploads
+# ------------------------------------------------------------------------------
+
+# The ``FileUpload`` represents an uploaded file. The data is spooled to memory
+# up to ``SPOOL_SIZE`` and to a temporary file beyond that, and can be read in
+# chunks from the ``file`` attribute, which is positioned at the start.
+#
+# It subclasses ``FieldStorage`` so that it can be used in place of one, e.g.
+# with ``blobstore.parse_file_info``. Accessing ``value`` will still read the
+# entire file into memory.
+class FileUpload(FieldStorage, object):
+
+    list = None
+
+    def __init__(self, name, filename, headers, file, size):
+        self.name = name
+        self.filename = filename
+        self.headers = headers
+        self.file = file
+        self.size = size
+        self.disposition, self.disposition_options = parse_header(
+            headers.get('content-disposition', '')
+            )
+        if 'content-type' in headers:
+            self.type, self.type_options = parse_header(headers['content-type'])
+        else:
+            self.type, self.type_options = 'application/octet-stream', {}
+
+    def __nonzero__(self):
+        return True
+
+    def __repr__(self):
+        return "FileUpload(%r, %r, size=%d)" % (
+            self.name, self.filename, self.size
+            )
+
+# ------------------------------------------------------------------------------
+# Body Reader
+# ------------------------------------------------------------------------------
+
+# The ``BodyReader`` makes sure that no more than ``length`` bytes are ever read
+# from the underlying WSGI input.
+class BodyReader(object):
+
+    def __init__(self, fp, length, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.fp = fp
+        self.remaining = length
+
+    def read(self):
+        size = min(self.chunk_size, self.remaining)
+        if size <= 0:
+            return ''
+        data = self.fp.read(size)
+        if data:
+            self.remaining -= len(data)
+        else:
+            self.remaining = 0
+        return data
+
+# ------------------------------------------------------------------------------
+# Parsers
+# ------------------------------------------------------------------------------
+
+def get_boundary(content_type):
+    boundary = parse_header(content_type)[1].get('boundary', '')
+    if not boundary or not valid_boundary(boundary):
+        raise ParseError("Invalid multipart boundary: %r" % boundary)
+    return boundary
+
+def parse_part_headers(data):
+    headers = {}
+    for line in data.split('\r\n'):
+        if not line:
+            continue
+        if ':' not in line:
+            raise ParseError("Invalid multipart header: %r" % line)
+        key, value = line.split(':', 1)
+        headers[key.strip().lower()] = value.strip()
+    return headers
+
+# Yield ``(name, value)`` pairs from a multipart/form-data body. The value is
+# a ``FileUpload`` for parts with a filename, and a byte string otherwise.
+def iter_multipart(
+    fp, length, boundary, spool_size=SPOOL_SIZE, chunk_size=CHUNK_SIZE
+    ):
+    read = BodyReader(fp, length, chunk_size).read
+    delimiter = '\r\n--' + boundary
+    keep = len(delimiter) - 1
+    # The body is prefixed with a CRLF so that the first boundary can be found
+    # with the same delimiter as the rest.
+    buf = '\r\n' + read()
+    while 1:
+        idx = buf.find(delimiter)
+        if idx != -1:
+            buf = buf[idx + keep + 1:]
+            break
+        buf = buf[-keep:]
+        data = read()
+        if not data:
+            raise ParseError("Multipart boundary not found.")
+        buf += data
+    while 1:
+        # A delimiter is followed by either "--" for the final part, or by
+        # optional whitespace and then a CRLF.
+        while 1:
+            idx = buf.find('\r\n')
+            if idx != -1 or buf[:2] == '--':
+                break
+            if len(buf) > MAX_HEADER_SIZE:
+                raise ParseError("Invalid multipart delimiter.")
+            data = read()
+            if not data:
+                raise ParseError("Truncated multipart body.")
+            buf += data
+        if buf[:2] == '--':
+            return
+        buf = buf[idx + 2:]
+        while 1:
+            if buf.startswith('\r\n'):
+                idx = -2
+                break
+            idx = buf.find('\r\n\r\n')
+            if idx != -1:
+                break
+            if len(buf) > MAX_HEADER_SIZE:
+                raise ParseError("Multipart headers too large.")
+            data = read()
+            if not data:
+                raise ParseError("Truncated multipart body.")
+            buf += data
+        headers = parse_part_headers(buf[:max(idx, 0)])
+        buf = buf[idx + 4:]
+        disposition = parse_header(headers.get('content-disposition', ''))[1]
+        name = disposition.get('name')
+        filename = disposition.get('filename')
+        if filename:
+            sink = SpooledTemporaryFile(max_size=spool_size)
+        else:
+            sink = StringIO()
+        write = sink.write
+        size = 0
+        while 1:
+            idx = buf.find(delimiter)
+            if idx != -1:
+                write(buf[:idx])
+                size += idx
+                buf = buf[idx + keep + 1:]
+                break
+            # Hold back enough of the buffer to catch a delimiter that spans
+            # two chunks.
+            if len(buf) > keep:
+                write(buf[:-keep])
+                size += len(buf) - keep
+                buf = buf[-keep:]
+            data = read()
+            if not data:
+                raise ParseError("Truncated multipart body.")
+            buf += data
+        if name is None:
+            continue
+        if filename:
+            sink.seek(0)
+            yield name, FileUpload(name, filename, headers, sink, size)
+        else:
+            yield name, sink.getvalue()
+
+# Yield ``(name, value)`` pairs from an application/x-www-form-urlencoded body,
+# keeping blank values.
+def iter_urlencoded(fp, length, chunk_size=CHUNK_SIZE):
+    read = BodyReader(fp, length, chunk_size).read
+    buf = ''
+    while 1:
+        data = read()
+        if not data:
+            break
+        buf += data
+        # Only decode up to the last separator, as the rest of the buffer may
+        # be part of a pair that spans two chunks.
+        idx = max(buf.rfind('&'), buf.rfind(';'))
+        if idx != -1:
+            for pair in iter_form_pairs(buf[:idx]):
+                yield pair
+            buf = buf[idx + 1:]
+    for pair in iter_form_pairs(buf):
+        yield pair
@@ -0,0 +1,143 @@
+# Public Domain (-) 2017 The GitFund Authors.
+# See the GitFund UNLICENSE file for details.
+
+"""Route trie used by weblite to dispatch requests to handlers."""
+
+# ------------------------------------------------------------------------------
+# Route Trie
+# ------------------------------------------------------------------------------
+
+# Routes are registered using one of three forms of pattern:
+#
+# * ``/`` -- matches the site root.
+#
+# * ``name`` -- matches any path whose first segment is ``name``, with the
+#   remaining segments being passed on as positional arguments. This is the
+#   traditional weblite handler form, e.g. ``sponsor.image/<id>/<height>``.
+#
+# * ``/seg/<param>/...`` -- matches a path with exactly the given segments,
+#   where ``<param>`` segments match anything and are passed on as keyword
+#   arguments.
+#
+# When matching, static segments take precedence over parameters, and a
+# handler's name counts as a static first segment. So ``/stripe.webhook/<x>``
+# goes to the ``stripe.webhook`` handler rather than ``/<owner>/<project>``,
+# like it did when the latter was a fallback for unknown names. Below a name,
+# any routes registered under it, e.g. ``/page/<slug>``, take precedence over
+# the positional form of the handler itself.
+class RouteNode(object):
+
+    __slots__ = ('exact', 'param', 'param_name', 'prefix', 'static')
+
+    def __init__(self):
+        self.exact = None
+        self.param = None
+        self.param_name = None
+        self.prefix = None
+        self.static = {}
+
+class Router(object):
+
+    def __init__(self):
+        self.leaves = {}
+        self.root = RouteNode()
+
+    def add(self, pattern, entry):
+        self.add_route(pattern, entry)
+        # The leaves dict is updated in place so that callers can hold on to a
+        # reference to it.
+        leaves = self.leaves
+        leaves.clear()
+        for segment, node in self.root.static.iteritems():
+            if node.prefix is None or node.exact is not None:
+                continue
+            if node.param is None and not node.static:
+                leaves[segment] = node.prefix
+
+    def add_route(self, pattern, entry):
+        node = self.root
+        if pattern == '/':
+            node.exact = entry
+            return
+        if not pattern.startswith('/'):
+            if '<' in pattern:
+                raise ValueError("invalid route pattern: %s" % pattern)
+            node = node.static.setdefault(pattern, RouteNode())
+            node.prefix = entry
+            return
+        for segment in pattern.split('/'):
+            if not segment:
+                continue
+            if segment.startswith('<') and segment.endswith('>'):
+                name = segment[1:-1]
+                if not name:
+                    raise ValueError("invalid route pattern: %s" % pattern)
+                if node.param is None:
+                    node.param = RouteNode()
+                    node.param_name = name
+                elif node.param_name != name:
+                    raise ValueError(
+                        "conflicting parameter names in route %s: %s != %s"
+                        % (pattern, name, node.param_name)
+                        )
+                node = node.param
+            else:
+                if segment not in node.static:
+                    node.static[segment] = RouteNode()
+                node = node.static[segment]
+        node.exact = entry
+
+    # Return a tuple of ``(entry, args, params)`` for the given path segments,
+    # or ``None`` if there is no matching route.
+    #
+    # Most requests are for traditional handlers with no nested routes, so
+    # callers can look these up directly in ``leaves`` by the first segment
+    # and only fall back to walking the trie for everything else. A name in
+    # ``leaves`` has nothing registered under it, so its positional form is
+    # what the walk would find for any path starting with it.
+    def match(self, segments):
+        if segments:
+            entry = self.leaves.get(segments[0])
+            if entry is not None:
+                return entry, segments[1:], ()
+        elif self.root.exact is not None:
+            return self.root.exact, (), ()
+        # Try a straight walk down the trie first, and only backtrack if that
+        # doesn't result in a match.
+        node = self.root
+        params = []
+        for segment in segments:
+            child = node.static.get(segment)
+            if child is None:
+                if node.param is None:
+                    break
+                params.append((node.param_name, segment))
+                child = node.param
+            node = child
+        else:
+            if node.exact is not None:
+                return node.exact, (), params
+        return match_node(self.root, segments, 0, len(segments), ())
+
+def match_node(node, segments, idx, end, params):
+    if idx == end:
+        if node.exact is not None:
+            return node.exact, (), params
+        if node.prefix is not None:
+            return node.prefix, (), params
+        return
+    segment = segments[idx]
+    child = node.static.get(segment)
+    if child is not None:
+        found = match_node(child, segments, idx + 1, end, params)
+        if found:
+            return found
+    if node.param is not None:
+        found = match_node(
+            node.param, segments, idx + 1, end,
+            params + ((node.param_name, segment),)
+            )
+        if found:
+            return found
+    if node.prefix is not None:
+        return node.prefix, segments[idx:], params
@@ -0,0 +1,278 @@
+# Public Domain (-) 2017 The GitFund Authors.
+# See the GitFund UNLICENSE file for details.
+
+"""Sharded sponsor slot counters with reservations."""
+
+import logging
+
+from random import shuffle
+from time import time
+
+from google.appengine.ext import db
+from google.appengine.ext.db import (
+    create_transaction_options, run_in_transaction_options
+    )
+
+from finance import PLAN_SLOTS
+from generations import bump_generations
+from model import SponsorRecord, SponsorSlots
+
+# ------------------------------------------------------------------------------
+# Constants
+# ------------------------------------------------------------------------------
+
+# Reservations which aren't confirmed within this many seconds are released by
+# ``release_expired_reservations``.
+RESERVATION_TIMEOUT = 1800
+
+SHARDS = 8
+
+XG_TRANSACTION = create_transaction_options(xg=True)
+
+# ------------------------------------------------------------------------------
+# Sponsor Slots
+# ------------------------------------------------------------------------------
+
+# The slots for each plan are split across ``SponsorSlots`` shards, which each
+# own a fixed share of the plan's ``PLAN_SLOTS``. This enforces the limits
+# exactly, without every sponsorship change going through one entity group.
+# A user's hold on a slot is tracked by their ``SponsorRecord``, which is
+# updated in the same cross-group transaction as the shards it affects.
+#
+# Slots are first reserved, e.g. when a sponsor checks out, and the reservation
+# is then confirmed when the user's totals are synced.
+def get_slot_capacity(plan, idx):
+    slots = PLAN_SLOTS[plan]
+    shards = get_slot_shard_count(plan)
+    return slots // shards + (idx < slots % shards)
+
+def get_slot_counts():
+    ensure_migrated()
+    plans = []
+    keys = []
+    for plan in sorted(PLAN_SLOTS):
+        for key in get_slot_keys(plan):
+            plans.append(plan)
+            keys.append(key)
+    counts = dict.fromkeys(PLAN_SLOTS, 0)
+    for plan, shard in zip(plans, SponsorSlots.get_by_key_name(keys)):
+        if shard:
+            counts[plan] += shard.confirmed
+    return counts
+
+def get_slot_keys(plan):
+    return [
+        'gitfund.%s.%d' % (plan, idx)
+        for idx in range(get_slot_shard_count(plan))
+    ]
+
+def get_slot_shard(plan, idx):
+    key = 'gitfund.%s.%d' % (plan, idx)
+    shard = SponsorSlots.get_by_key_name(key)
+    if not shard:
+        shard = SponsorSlots(key_name=key)
+    return shard
+
+def get_slot_shard_count(plan):
+    return min(SHARDS, PLAN_SLOTS[plan])
+
+def get_sponsor_record(user_id):
+    record = SponsorRecord.get_by_key_name(user_id)
+    if not record:
+        record = SponsorRecord(key_name=user_id)
+    return record
+
+# Release a user's reservation, and return the shard it was held on, so that
+# it can be saved along with the record.
+def release_reservation(record):
+    shard = get_slot_shard(record.reserved, record.reserved_shard)
+    shard.reserved -= 1
+    record.reserved = ''
+    record.reserved_expires = 0
+    record.reserved_shard = 0
+    return shard
+
+def release_expired_reservation_txn(user_id, now):
+    record = SponsorRecord.get_by_key_name(user_id)
+    if not (record and record.reserved and record.reserved_expires < now):
+        return False
+    db.put([record, release_reservation(record)])
+    return True
+
+# Release any reservations that were never confirmed, e.g. because the checkout
+# failed part way through, and return the number released.
+def release_expired_reservations():
+    now = int(time())
+    released = 0
+    for key in SponsorRecord.all(keys_only=True).filter(
+        'reserved_expires >', 0
+    ).filter('reserved_expires <', now).run(batch_size=100):
+        if run_in_transaction_options(
+            XG_TRANSACTION, release_expired_reservation_txn, key.name(), now
+        ):
+            released += 1
+    return released
+
+# Reserve a slot on the given plan for the user, and return whether one was
+# available. Shards which look like they have space are tried in a random
+# order, and their capacity is checked again within the transaction.
+def reserve_sponsor_slot(user_id, plan):
+    ensure_migrated()
+    user_id = str(user_id)
+    keys = get_slot_keys(plan)
+    available = []
+    for idx, shard in enumerate(SponsorSlots.get_by_key_name(keys)):
+        used = shard and (shard.confirmed + shard.reserved) or 0
+        if used < get_slot_capacity(plan, idx):
+            available.append(idx)
+    shuffle(available)
+    for idx in available:
+        if run_in_transaction_options(
+            XG_TRANSACTION, reserve_sponsor_slot_txn, user_id, plan, idx
+        ):
+            return True
+    # The user may already hold a slot on the plan even if it's full.
+    return run_in_transaction_options(
+        XG_TRANSACTION, reserve_sponsor_slot_txn, user_id, plan, None
+    )
+
+def reserve_sponsor_slot_txn(user_id, plan, idx):
+    record = get_sponsor_record(user_id)
+    if record.plan == plan:
+        return True
+    expires = int(time()) + RESERVATION_TIMEOUT
+    if record.reserved == plan:
+        record.reserved_expires = expires
+        record.put()
+        return True
+    if idx is None:
+        return False
+    shard = get_slot_shard(plan, idx)
+    if (shard.confirmed + shard.reserved) >= get_slot_capacity(plan, idx):
+        return False
+    entities = [record, shard]
+    if record.reserved:
+        entities.append(release_reservation(record))
+    shard.reserved += 1
+    record.reserved = plan
+    record.reserved_expires = expires
+    record.reserved_shard = idx
+    db.put(entities)
+    return True
+
+# Bring the slot held by the user in line with their plan, and return whether
+# the plan was full. Any slot on a previous plan is released, and a slot on the
+# new plan is reserved and then confirmed.
+def sync_sponsor_slot(user_id, plan, version):
+    ensure_migrated()
+    user_id = str(user_id)
+    if plan in PLAN_SLOTS:
+        reserve_sponsor_slot(user_id, plan)
+    return run_in_transaction_options(
+        XG_TRANSACTION, sync_sponsor_slot_txn, user_id, plan, version
+    )
+
+# TODO(tav): It's possible for this to return different results depending on the
+# order of retry.
+def sync_sponsor_slot_txn(user_id, plan, version):
+    record = get_sponsor_record(user_id)
+    if record.version > version:
+        return 'old.version'
+    entities = [record]
+    maxed = False
+    if record.plan != plan:
+        if record.plan:
+            shard = get_slot_shard(record.plan, record.shard)
+            shard.confirmed -= 1
+            entities.append(shard)
+            record.plan = ''
+            record.shard = 0
+        if plan in PLAN_SLOTS:
+            if record.reserved == plan:
+                idx = record.reserved_shard
+                shard = release_reservation(record)
+                shard.confirmed += 1
+                entities.append(shard)
+                record.plan = plan
+                record.shard = idx
+            else:
+                maxed = True
+    if record.reserved and record.reserved != record.plan:
+        entities.append(release_reservation(record))
+    record.version = version
+    db.put(entities)
+    return maxed
+
+# ------------------------------------------------------------------------------
+# Migration
+# ------------------------------------------------------------------------------
+
+# The slots used to be counted on a single ``SponsorTotals`` entity, which kept
+# the per-plan totals as a JSON blob, with a ``SponsorRecord`` child for each
+# user. Each of those records is moved over in its own cross-group transaction,
+# which adds the slot it held to a shard and deletes it, so that it is only
+# ever counted once, however many requests are migrating at the same time.
+#
+# Nothing reads or changes the slots until the old group is empty, so that the
+# existing sponsors are always counted against the limits. Once an instance
+# has seen that it is empty, it doesn't check again.
+LEGACY_PARENT = db.Key.from_path('SponsorTotals', 'gitfund')
+
+MIGRATED = []
+
+def ensure_migrated():
+    if MIGRATED:
+        return
+    migrate_sponsor_slots()
+    MIGRATED.append(True)
+
+def migrate_sponsor_record_txn(old_key):
+    old = SponsorRecord.get(old_key)
+    if not old:
+        return False
+    user_id = old_key.name()
+    entities = []
+    # Users who already have a root record were migrated before the old
+    # record could be deleted, or have been changed since by the new code.
+    if not SponsorRecord.get_by_key_name(user_id):
+        record = SponsorRecord(key_name=user_id, version=old.version)
+        entities.append(record)
+        if old.plan in PLAN_SLOTS:
+            for idx in range(get_slot_shard_count(old.plan)):
+                shard = get_slot_shard(old.plan, idx)
+                used = shard.confirmed + shard.reserved
+                if used < get_slot_capacity(old.plan, idx):
+                    shard.confirmed += 1
+                    record.plan = old.plan
+                    record.shard = idx
+                    entities.append(shard)
+                    break
+            else:
+                logging.error(
+                    "No %s slot left to migrate user %s to"
+                    % (old.plan, user_id)
+                )
+        db.put(entities)
+    db.delete(old_key)
+    return True
+
+# Migrate any records left in the old group, and return the number migrated.
+# The ancestor query is strongly consistent, so an empty result means that the
+# migration is complete. The cached totals are refreshed if anything moved.
+def migrate_sponsor_slots():
+    migrated = 0
+    while 1:
+        keys = SponsorRecord.all(keys_only=True).ancestor(
+            LEGACY_PARENT
+        ).fetch(100)
+        if not keys:
+            break
+        for key in keys:
+            if run_in_transaction_options(
+                XG_TRANSACTION, migrate_sponsor_record_txn, key
+            ):
+                migrated += 1
+    if migrated:
+        db.delete(LEGACY_PARENT)
+        bump_generations('totals')
+    return migrated
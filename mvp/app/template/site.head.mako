@@ -0,0 +1,6 @@
+<!doctype html>
+<meta charset=utf-8>
+<meta name="viewport" content="width=device-width">
+<link rel="icon" type="image/png" href="/favicon.ico?v=1">
+<link rel="stylesheet" href="${STATIC('site.css')}">
+<link rel="preload" href="${STATIC('site.js')}" as="script">
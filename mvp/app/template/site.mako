@@ -1,6 +1,6 @@
-<!doctype html>
-<meta charset=utf-8>
-<meta name="viewport" content="width=device-width">
+% if not ctx.flushed:
+<%include file="site.head"/>
+% endif
 % if ctx.site_title:
 <title>${ctx.site_title|h}</title>
 % else:
@@ -32,8 +32,6 @@
 <meta name="robots" content="noindex">
 % endif
 <meta name="emoji-attribution" content="Emoji art provided by EmojiOne under CC-BY-4.0">
-<link rel="icon" type="image/png" href="/favicon.ico?v=1">
-<link rel="stylesheet" href="${STATIC('site.css')}">
 <body>
 <script src="${STATIC('site.js')}"></script>
 % if ctx.stripe_js:
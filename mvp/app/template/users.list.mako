@@ -59,7 +59,8 @@
 	</table>
 	<div class="cursor">
 		% if cursor:
-		<a href="/users.list?cursor=${cursor}">More</a>
+		<a href="/users.list?cursor=${cursor}">More</a> ·
 		% endif
+		<a href="/users.export">Export CSV</a>
 	</div>
 </div>
\ No newline at end of file
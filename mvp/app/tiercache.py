@@ -0,0 +1,158 @@
+# Public Domain (-) 2017 The GitFund Authors.
+# See the GitFund UNLICENSE file for details.
+
+"""Two-tier cache with an in-process LRU in front of memcache."""
+
+from collections import OrderedDict
+from threading import Lock
+from time import sleep, time
+
+from google.appengine.api.memcache import (
+    add as add_cache, delete as delete_cache, get as get_cache,
+    set as set_cache
+    )
+
+# ------------------------------------------------------------------------------
+# LRU
+# ------------------------------------------------------------------------------
+
+# The ``LRU`` is a thread-safe, in-process cache bounded by the number of
+# entries.
+class LRU(object):
+
+    def __init__(self, max_entries=1000):
+        self.data = OrderedDict()
+        self.lock = Lock()
+        self.max_entries = max_entries
+
+    def __len__(self):
+        return len(self.data)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def get(self, key):
+        with self.lock:
+            value = self.data.pop(key, None)
+            if value is not None:
+                self.data[key] = value
+            return value
+
+    def pop(self, key):
+        with self.lock:
+            return self.data.pop(key, None)
+
+    def set(self, key, value):
+        with self.lock:
+            data = self.data
+            data.pop(key, None)
+            data[key] = value
+            while len(data) > self.max_entries:
+                data.popitem(last=False)
+
+# ------------------------------------------------------------------------------
+# Two-Tier Cache
+# ------------------------------------------------------------------------------
+
+# The ``TwoTierCache`` keeps ``(expires, value)`` entries in both an in-process
+# LRU and memcache. Local copies are only trusted for up to ``local_timeout``
+# seconds, so that invalidations elsewhere are picked up reasonably quickly.
+#
+# Memcache entries outlive their expiry by ``grace`` seconds. When a value has
+# expired, a lease is taken out in memcache so that only one request calls the
+# creation function, while concurrent requests serve the stale copy. If there
+# is no stale copy, they wait up to ``wait`` seconds for the new value before
+# creating it themselves.
+#
+# The stats counters are approximate, as they aren't updated under a lock.
+class TwoTierCache(object):
+
+    def __init__(
+        self, namespace, default_timeout=300, local_timeout=5, grace=300,
+        lease_timeout=10, max_entries=1000, wait=0.5
+        ):
+        self.default_timeout = default_timeout
+        self.grace = grace
+        self.lease_timeout = lease_timeout
+        self.local = LRU(max_entries)
+        self.local_timeout = local_timeout
+        self.namespace = namespace
+        self.stats = dict.fromkeys([
+            'local_hits', 'memcache_hits', 'misses', 'regenerations',
+            'stale_hits', 'waits'
+            ], 0)
+        self.wait = wait
+
+    def get(self, key):
+        now = time()
+        entry = self.local.get(key)
+        if entry is not None and entry[0] > now:
+            self.stats['local_hits'] += 1
+            return entry[1]
+        entry = get_cache(key, namespace=self.namespace)
+        if entry is not None and entry[0] > now:
+            self.set_local(key, entry, now)
+            self.stats['memcache_hits'] += 1
+            return entry[1]
+        self.stats['misses'] += 1
+
+    def get_or_create(self, key, create, timeout=None):
+        now = time()
+        stats = self.stats
+        stale = self.local.get(key)
+        if stale is not None and stale[0] > now:
+            stats['local_hits'] += 1
+            return stale[1]
+        namespace = self.namespace
+        entry = get_cache(key, namespace=namespace)
+        if entry is not None:
+            if entry[0] > now:
+                self.set_local(key, entry, now)
+                stats['memcache_hits'] += 1
+                return entry[1]
+            stale = entry
+        stats['misses'] += 1
+        lease = 'lease|' + key
+        if add_cache(lease, 1, time=self.lease_timeout, namespace=namespace):
+            try:
+                return self.create(key, create, timeout)
+            finally:
+                delete_cache(lease, namespace=namespace)
+        if stale is not None:
+            stats['stale_hits'] += 1
+            return stale[1]
+        deadline = now + self.wait
+        while time() < deadline:
+            sleep(0.05)
+            entry = get_cache(key, namespace=namespace)
+            if entry is not None:
+                self.set_local(key, entry, time())
+                stats['waits'] += 1
+                return entry[1]
+        return self.create(key, create, timeout)
+
+    def create(self, key, create, timeout):
+        value = create()
+        self.set(key, value, timeout)
+        self.stats['regenerations'] += 1
+        return value
+
+    def invalidate(self, key):
+        self.local.pop(key)
+        delete_cache(key, namespace=self.namespace)
+
+    def set(self, key, value, timeout=None):
+        if not timeout:
+            timeout = self.default_timeout
+        now = time()
+        entry = (now + timeout, value)
+        set_cache(key, entry, time=timeout + self.grace, namespace=self.namespace)
+        self.set_local(key, entry, now)
+
+    def set_local(self, key, entry, now):
+        expires = now + self.local_timeout
+        if entry[0] < expires:
+            self.local.set(key, entry)
+        else:
+            self.local.set(key, (expires, entry[1]))
@@ -0,0 +1,120 @@
+# Public Domain (-) 2017 The GitFund Authors.
+# See the GitFund UNLICENSE file for details.
+
+"""Per-handler latency histograms aggregated in memcache."""
+
+from bisect import bisect_left
+from threading import Lock
+from time import time
+
+from google.appengine.api.memcache import Client
+
+# ------------------------------------------------------------------------------
+# Constants
+# ------------------------------------------------------------------------------
+
+# The upper bounds, in milliseconds, of the histogram buckets. Durations beyond
+# the last bound are counted in a final overflow bucket.
+BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+BUCKET_LABELS = tuple('<%dms' % ms for ms in BUCKETS) + ('>%dms' % BUCKETS[-1],)
+
+FLUSH_INTERVAL = 60
+
+KEY_PREFIX = 'timing|'
+
+# The maximum number of counters fetched from memcache in a single RPC.
+MAX_GET_SIZE = 500
+
+# ------------------------------------------------------------------------------
+# Histograms
+# ------------------------------------------------------------------------------
+
+# The ``Histograms`` accumulate phase timings for each handler in-process, and
+# periodically add them to counters in memcache, so that they are aggregated
+# across instances. Each histogram is a list of the bucket counts, followed by
+# the total number of milliseconds recorded.
+class Histograms(object):
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL):
+        self.data = {}
+        self.flush_interval = flush_interval
+        self.last_flush = time()
+        self.lock = Lock()
+        self.size = len(BUCKETS) + 2
+
+    def record(self, handler, timings):
+        data = self.data
+        size = self.size
+        with self.lock:
+            for phase, duration in timings:
+                ms = duration * 1000
+                key = handler + '|' + phase
+                counts = data.get(key)
+                if counts is None:
+                    counts = data[key] = [0] * size
+                counts[bisect_left(BUCKETS, ms)] += 1
+                counts[-1] += int(ms + 0.5)
+            if time() - self.last_flush < self.flush_interval:
+                return
+            data = self.data
+            self.data = {}
+            self.last_flush = time()
+        self.flush(data)
+
+    # The counters are updated with an async RPC, which the runtime will wait
+    # on at the end of the request, so that the flush doesn't hold up the
+    # response.
+    def flush(self, data):
+        offsets = {}
+        for key, counts in data.iteritems():
+            prefix = KEY_PREFIX + key + '|'
+            for idx, count in enumerate(counts):
+                if count:
+                    offsets[prefix + str(idx)] = count
+        if offsets:
+            Client().offset_multi_async(offsets, initial_value=0)
+
+# Return a dict mapping ``(handler, phase)`` to the aggregated histogram for
+# the given pairs, skipping those with no recorded timings. The counters are
+# fetched in chunks of ``MAX_GET_SIZE`` keys, with the RPCs made in parallel,
+# as there are over a dozen for each pair.
+def load_histograms(pairs):
+    size = len(BUCKETS) + 2
+    keys = []
+    for handler, phase in pairs:
+        prefix = '%s%s|%s|' % (KEY_PREFIX, handler, phase)
+        keys.extend(prefix + str(idx) for idx in xrange(size))
+    client = Client()
+    rpcs = [
+        client.get_multi_async(keys[idx:idx+MAX_GET_SIZE])
+        for idx in xrange(0, len(keys), MAX_GET_SIZE)
+        ]
+    cached = {}
+    for rpc in rpcs:
+        cached.update(rpc.get_result())
+    histograms = {}
+    for handler, phase in pairs:
+        prefix = '%s%s|%s|' % (KEY_PREFIX, handler, phase)
+        counts = [
+            int(cached.get(prefix + str(idx)) or 0) for idx in xrange(size)
+            ]
+        if any(counts[:-1]):
+            histograms[(handler, phase)] = counts
+    return histograms
+
+# Return an estimate of the given percentile from a histogram, i.e. the upper
+# bound of the bucket in which it falls.
+def get_percentile(counts, percentile):
+    total = sum(counts[:-1])
+    if not total:
+        return 0
+    threshold = total * percentile / 100.0
+    seen = 0
+    for idx, count in enumerate(counts[:-1]):
+        seen += count
+        if seen >= threshold:
+            if idx < len(BUCKETS):
+                return BUCKETS[idx]
+            break
+    return float('inf')
@@ -0,0 +1,66 @@
+# Public Domain (-) 2017 The GitFund Authors.
+# See the GitFund UNLICENSE file for details.
+
+"""Single-pass decoder for query strings and urlencoded form data."""
+
+import re
+
+from urllib import unquote as urlunquote
+
+# ------------------------------------------------------------------------------
+# Decoder
+# ------------------------------------------------------------------------------
+
+# Queries are split into ``key[=value]`` parts on both the ``&`` and ``;``
+# separators, with the common case of no ``;`` handled by a plain split.
+split_parts = re.compile('[&;]').split
+
+def unquote(value):
+    if '+' in value:
+        value = value.replace('+', ' ')
+    if '%' in value:
+        return urlunquote(value)
+    return value
+
+# Decode the query string into the given ``kwargs`` dict. Values are decoded as
+# UTF-8, and blank values are set to ``None``. Later values for repeated keys
+# override earlier ones.
+def decode_query(query, kwargs, unicode=unicode):
+    if query[:1] == '?':
+        query = query.lstrip('?')
+    if ';' in query:
+        parts = split_parts(query)
+    else:
+        parts = query.split('&')
+    for part in parts:
+        if not part:
+            continue
+        key, _, value = part.partition('=')
+        if key and ('+' in key or '%' in key):
+            key = unquote(key)
+        if value:
+            # Values without any escapes, e.g. plain ASCII, skip unquoting.
+            if '+' in value or '%' in value:
+                value = unquote(value)
+            value = unicode(value, 'utf-8', 'strict')
+        else:
+            value = None
+        kwargs[key] = value
+    return kwargs
+
+# Yield ``(key, value)`` byte string pairs from urlencoded form data, keeping
+# blank values as empty strings.
+def iter_form_pairs(data):
+    if ';' in data:
+        parts = split_parts(data)
+    else:
+        parts = data.split('&')
+    for part in parts:
+        if not part:
+            continue
+        key, _, value = part.partition('=')
+        if key and ('+' in key or '%' in key):
+            key = unquote(key)
+        if value and ('+' in value or '%' in value):
+            value = unquote(value)
+        yield key, value
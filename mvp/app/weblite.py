@@ -9,19 +9,21 @@ import sys
 
 from BaseHTTPServer import BaseHTTPRequestHandler
 from binascii import hexlify
-from cgi import FieldStorage
-from Cookie import SimpleCookie
+from calendar import timegm
 from cStringIO import StringIO
 from datetime import datetime
-from hashlib import md5
+from email.utils import formatdate, mktime_tz, parsedate_tz
+from hashlib import md5, sha1, sha256
+from hmac import new as hmac
+from imp import load_source
 from json import loads as json_decode
-from os import urandom
+from os import listdir, urandom
 from os.path import dirname, exists, join, getmtime, realpath
 from threading import local
+from time import time
 from traceback import format_exception
 from urllib import quote as urlquote, urlencode, unquote as urlunquote
 from urlparse import urljoin
-from wsgiref.headers import Headers
 
 from google.appengine.ext.blobstore import parse_file_info
 from google.appengine.runtime.apiproxy_errors import CapabilityDisabledError
@@ -32,8 +34,10 @@ APP_ROOT = realpath(dirname(__file__))
 sys.path.insert(0, APP_ROOT)
 sys.path.insert(0, 'lib')
 
+from mako.cache import CacheImpl, register_plugin as register_cache_plugin
+from mako.codegen import MAGIC_NUMBER as MAKO_MAGIC_NUMBER
 from mako.exceptions import RichTraceback
-from mako.template import Template as MakoTemplate
+from mako.template import ModuleTemplate, Template as MakoTemplate
 
 from tavutil.exception import html_format_exception
 from tavutil.crypto import (
@@ -49,6 +53,21 @@ from config import (
     SECURE_COOKIE_KEY, STATIC_HANDLER, TASK_AUTH
     )
 
+from compression import (
+    COMPRESSIBLE_TYPES, VariantCache, compress, select_encoding
+    )
+
+from cookies import format_set_cookie, get_cookie_value
+
+from multipart import (
+    FileUpload, ParseError, get_boundary, iter_multipart, iter_urlencoded
+    )
+
+from routing import Router
+from tiercache import TwoTierCache
+from timing import Histograms, load_histograms
+from urldecode import decode_query
+
 # ------------------------------------------------------------------------------
 # Utility File Reader
 # ------------------------------------------------------------------------------
@@ -63,10 +82,6 @@ def read(file):
 # Constants
 # ------------------------------------------------------------------------------
 
-COOKIE_KEY_NAMES = frozenset([
-    'domain', 'expires', 'httponly', 'max-age', 'path', 'secure', 'version'
-    ])
-
 HTTP_STATUS_MESSAGES = BaseHTTPRequestHandler.responses
 
 RESPONSE_NOT_IMPLEMENTED = ("501 Not Implemented", [])
@@ -82,6 +97,10 @@ RESPONSE_HEADERS_HTML = [
 STATUS_301 = "301 Moved Permanently"
 STATUS_302 = "302 Found"
 
+# Redirects raised after a response has been flushed can only be done within
+# the page itself.
+FLUSHED_REDIRECT = '<meta http-equiv="refresh" content="0; url=%s">'
+
 RESPONSE_401 = ("401 Unauthorized", RESPONSE_HEADERS_HTML +
                 [("WWW-Authenticate", "Token realm='Service', error='token_expired'")])
 RESPONSE_403 = ("403 Forbidden", RESPONSE_HEADERS_HTML)
@@ -95,6 +114,7 @@ else:
     RUNNING_ON_GOOGLE_SERVERS = False
 
 HANDLERS = {}
+ROUTES = Router()
 SUPPORTED_HTTP_METHODS = frozenset(['GET', 'HEAD', 'POST'])
 
 VALID_REQUEST_CONTENT_TYPES = frozenset([
@@ -235,19 +255,37 @@ try:
 except ImportError:
     SSL_ONLY = True
 
+try:
+    from config import MAX_BODY_SIZE
+except ImportError:
+    MAX_BODY_SIZE = 2 << 20
+
+try:
+    from config import COMPRESS_MIN_SIZE
+except ImportError:
+    COMPRESS_MIN_SIZE = 1024
+
 HANDLER_DEFAULT_CONFIG = {
     'admin': False,
     'anon': True,
     'blob': False,
     'cache': None,
+    'compress': True,
     'cron': None,
+    'flush': None,
+    'max_body_size': MAX_BODY_SIZE,
     'post_encoding': False,
+    'raw_body': False,
     'ssl': SSL_ONLY,
     'task': None,
+    'validate': None,
     'xsrf': False
     }
 
 # The ``handle`` decorator is used to turn a function into a handler.
+#
+# Names starting with a ``/`` are treated as route patterns, e.g.
+# ``/<owner>/<project>``, and the handler is then named after the function.
 def handle(name=None, renderers=[], **config):
     if isinstance(name, (list, tuple)) and renderers == []:
         renderers = name
@@ -256,20 +294,27 @@ def handle(name=None, renderers=[], **config):
         parse_cache_config(config)
         __config = HANDLER_DEFAULT_CONFIG.copy()
         __config.update(config)
+        default_name = '.'.join(function.__name__.split('_'))
         if not name:
-            _name = '.'.join(function.__name__.split('_'))
+            patterns = [default_name]
+        else:
+            patterns = name.split()
+        for pattern in patterns:
+            if pattern.startswith('/') and pattern != '/':
+                _name = default_name
+            else:
+                _name = pattern
+            _config = __config.copy()
             if _name.startswith('cron.'):
-                __config['cron'] = True
+                _config['cron'] = True
             elif _name.startswith('task.'):
-                __config['task'] = True
-            HANDLERS[_name] = (function, renderers, __config)
-        else:
-            for _name in name.split():
-                if _name.startswith('cron.'):
-                    __config['cron'] = True
-                elif _name.startswith('task.'):
-                    __config['task'] = True
-                HANDLERS[_name] = (function, renderers, __config)
+                _config['task'] = True
+            entry = (
+                _name, function, renderers, _config,
+                compile_dispatch_plan(_config)
+                )
+            HANDLERS[_name] = entry
+            ROUTES.add(pattern, entry)
         return function
     if hasattr(name, '__call__'):
         function = name
@@ -291,6 +336,53 @@ def parse_cache_config(cfg, valid_values=set(['public', 'private', 'no-cache']))
         raise ValueError("invalid cache configuration: %s" % cache)
     cfg['cache'] = (cache, duration)
 
+# Each handler gets a dispatch plan compiled at registration time. This is a
+# tuple of just the checks that its config enables, so that requests don't
+# need to consult the config for every possible check.
+def check_admin(ctx, kwargs):
+    if not ctx.is_admin:
+        if ctx.user_id:
+            raise NotFound
+        raise Redirect(ctx.get_login_url())
+
+def check_cron(ctx, kwargs):
+    if not ctx.environ.get('HTTP_X_APPENGINE_CRON'):
+        ctx.check_task_auth(kwargs)
+
+def check_ssl(ctx, kwargs):
+    if not ctx.ssl_mode:
+        raise NotFound
+
+def check_task(ctx, kwargs):
+    if not ctx.environ.get('HTTP_X_APPENGINE_TASKNAME'):
+        ctx.check_task_auth(kwargs)
+
+def check_user(ctx, kwargs):
+    if not ctx.user_id:
+        raise Redirect(ctx.get_login_url())
+
+def check_xsrf(ctx, kwargs):
+    if 'xsrf' not in kwargs:
+        raise AuthError("XSRF token not present.")
+    ctx.validate_xsrf(kwargs.pop('xsrf'))
+
+def compile_dispatch_plan(config):
+    plan = []; add = plan.append
+    if RUNNING_ON_GOOGLE_SERVERS:
+        if config['cron']:
+            add(check_cron)
+        elif config['task']:
+            add(check_task)
+        elif config['ssl']:
+            add(check_ssl)
+    if config['xsrf']:
+        add(check_xsrf)
+    if config['admin']:
+        add(check_admin)
+    if not config['anon']:
+        add(check_user)
+    return tuple(plan)
+
 # ------------------------------------------------------------------------------
 # HTTP Utilities
 # ------------------------------------------------------------------------------
@@ -304,15 +396,186 @@ def get_http_datetime(timestamp=None):
         timestamp = datetime.utcnow()
     return timestamp.strftime('%a, %d %B %Y %H:%M:%S GMT') # %m
 
+# Handlers can be given a ``validate`` function, which is called with the same
+# arguments as the handler before it is run. It should cheaply return an ETag
+# value, a last modified time (as a UTC datetime or a timestamp), or a tuple of
+# both. If the request's conditional headers match, a 304 is returned without
+# running the handler at all.
+def apply_validator(ctx, validator, cache):
+    if isinstance(validator, tuple):
+        etag, last_modified = validator
+    elif isinstance(validator, (datetime, int, long, float)):
+        etag, last_modified = None, validator
+    else:
+        etag, last_modified = validator, None
+    headers = ctx.response_headers
+    if etag is not None:
+        etag = '"%s"' % etag
+        headers['Etag'] = etag
+    if last_modified is not None:
+        if isinstance(last_modified, datetime):
+            last_modified = timegm(last_modified.utctimetuple())
+        last_modified = int(last_modified)
+        headers['Last-Modified'] = formatdate(last_modified, usegmt=True)
+    if cache:
+        cache, duration = cache
+        if cache == 'public':
+            headers['Pragma'] = "Public"
+            headers['Cache-Control'] = "public, max-age=%d;" % duration
+        elif cache == 'private':
+            headers['Cache-Control'] = "private, max-age=%d;" % duration
+        else:
+            headers['Cache-Control'] = "no-cache"
+    if is_not_modified(ctx.environ, etag, last_modified):
+        ctx.set_response_status(304)
+        raise HTTPContent("")
+
+def is_not_modified(env, etag, last_modified):
+    # If-None-Match takes precedence over If-Modified-Since when both are
+    # present, as per RFC 7232.
+    if_none_match = env.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        if etag is None:
+            return False
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag == '*':
+                return True
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag == etag:
+                return True
+        return False
+    if_modified_since = env.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and last_modified is not None:
+        parsed = parsedate_tz(if_modified_since.split(';', 1)[0])
+        if parsed:
+            return last_modified <= mktime_tz(parsed)
+    return False
+
+# Compress the response body if the client accepts a supported encoding and the
+# response is of a compressible type and large enough to be worth it. If the
+# handler has set ``ctx.compress_key``, e.g. because the response was served
+# from a server-side cache, the compressed variants are cached under that key.
+def compress_response(ctx, content, variants=VariantCache()):
+    headers = ctx.response_headers
+    if 'Content-Encoding' in headers:
+        return content
+    ctype = headers['Content-Type'].split(';', 1)[0].strip().lower()
+    if ctype not in COMPRESSIBLE_TYPES:
+        return content
+    vary = headers['Vary']
+    if not vary:
+        headers['Vary'] = 'Accept-Encoding'
+    elif 'accept-encoding' not in vary.lower():
+        headers['Vary'] = vary + ', Accept-Encoding'
+    if len(content) < COMPRESS_MIN_SIZE:
+        return content
+    encoding = select_encoding(ctx.environ.get('HTTP_ACCEPT_ENCODING', ''))
+    if not encoding:
+        return content
+    key = ctx.compress_key
+    if key:
+        body = variants.get(key, encoding, content)
+    else:
+        body = compress(content, encoding)
+    if len(body) >= len(content):
+        return content
+    headers['Content-Encoding'] = encoding
+    # The ETag is for the uncompressed representation, so it is weakened for
+    # the compressed one.
+    etag = headers['Etag']
+    if etag and etag.startswith('"'):
+        headers['Etag'] = 'W/' + etag
+    return body
+
+# ------------------------------------------------------------------------------
+# Response Headers
+# ------------------------------------------------------------------------------
+
+# The ``ResponseHeaders`` is a minimal, insertion ordered, replacement for
+# ``wsgiref.headers.Headers``. Like it, names are case-insensitive, getting a
+# missing header returns ``None``, and setting a header replaces any existing
+# values. Responses only ever have a handful of headers, so a list of pairs is
+# cheaper than maintaining an index.
+class ResponseHeaders(object):
+
+    __slots__ = ('_items',)
+
+    def __init__(self):
+        self._items = []
+
+    def __contains__(self, name):
+        name = name.lower()
+        for key, _ in self._items:
+            if key.lower() == name:
+                return True
+        return False
+
+    def __delitem__(self, name):
+        name = name.lower()
+        items = self._items
+        for key, _ in items:
+            if key.lower() == name:
+                items[:] = [item for item in items if item[0].lower() != name]
+                return
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __setitem__(self, name, value):
+        if self._items:
+            del self[name]
+        self._items.append((name, value))
+
+    def add_header(self, name, value):
+        self._items.append((name, value))
+
+    def get(self, name, default=None):
+        name = name.lower()
+        for key, value in self._items:
+            if key.lower() == name:
+                return value
+        return default
+
+    def get_all(self, name):
+        name = name.lower()
+        return [value for key, value in self._items if key.lower() == name]
+
+    def items(self):
+        return self._items[:]
+
 # ------------------------------------------------------------------------------
 # Context
 # ------------------------------------------------------------------------------
 
+# The ``UNSET`` sentinel marks lazily computed ``Context`` fields which haven't
+# been computed yet, as ``None`` is often a valid value for them.
+UNSET = object()
+
 # The ``Context`` class encompasses the HTTP request/response. An instance,
 # specific to the current request, is passed in as the first parameter to all
 # handlers.
+#
+# The fields used by weblite itself are slotted, while the ``__dict__`` slot
+# lets apps continue to set their own attributes, e.g. ``ctx.page_title``. The
+# instance dict is only created when an app does so. Response headers and
+# cookies are also only created when first used.
 class Context(object):
 
+    __slots__ = (
+        '__dict__', '_flush', '_flushed_headers', '_headers', '_is_admin',
+        '_request_cookies', '_request_json', '_response_cookies', '_site_url',
+        '_status',
+        '_url', '_url_with_qs', '_user', '_user_id', '_xsrf_token',
+        'compress_key', 'current_template', 'end_pipeline', 'environ',
+        'flushed', 'host', 'name', 'request_body', 'scheme', 'shared_render',
+        'ssl_mode', 'timings', 'was_routed'
+        )
+
     DEBUG = DEBUG
     STATIC = staticmethod(STATIC)
 
@@ -320,60 +583,110 @@ class Context(object):
     urlquote = staticmethod(urlquote)
     urlunquote = staticmethod(urlunquote)
 
-    end_pipeline = None
     site_host = None
 
-    _cookies_parsed = None
-    _xsrf_token = None
-
     after_runners = []
 
     def __init__(self, name, environ, ssl_mode):
         self.name = name
         self.environ = environ
         self.host = environ['HTTP_HOST']
-        self._status = (200, 'OK')
-        self._raw_headers = []
-        self._response_cookies = {}
-        self.response_headers = Headers(self._raw_headers)
         self.ssl_mode = ssl_mode
         if ssl_mode:
             self.scheme = 'https'
         else:
             self.scheme = 'http'
+        self.compress_key = None
+        self.current_template = None
+        self.end_pipeline = None
+        self.flushed = False
+        self.request_body = None
+        self.shared_render = False
+        self.timings = ()
+        self.was_routed = 0
+        self._flush = None
+        self._flushed_headers = 0
+        self._headers = None
+        self._is_admin = UNSET
+        self._request_cookies = None
+        self._request_json = UNSET
+        self._response_cookies = None
+        self._site_url = None
+        self._status = (200, 'OK')
+        self._url = None
+        self._url_with_qs = None
+        self._user = UNSET
+        self._user_id = UNSET
+        self._xsrf_token = None
+
+    # Handlers with a ``flush`` template configured can call ``flush`` to send
+    # the response headers and the rendered template straight away, e.g. before
+    # making slow RPC calls. The layout is then expected to skip rendering the
+    # flushed part. Any later changes to the status, headers or cookies are
+    # ignored, so handlers should only flush once they know they will succeed.
+    #
+    # Flushed responses aren't compressed, and the python27 runtime buffers
+    # whatever is written until the handler returns, so this should only be
+    # used on runtimes which stream the WSGI output.
+    def flush(self):
+        if self._flush:
+            self._flush()
+
+    @property
+    def response_headers(self):
+        headers = self._headers
+        if headers is None:
+            headers = self._headers = ResponseHeaders()
+        return headers
+
+    # Return the raw response headers, without creating the container if no
+    # headers have been set.
+    def get_raw_headers(self):
+        if self._headers is None:
+            return []
+        return self._headers._items
 
     def set_response_status(self, code, message=None):
         if not message:
             message = HTTP_STATUS_MESSAGES.get(code, ["Server Error"])[0]
         self._status = (code, message)
 
-    def _parse_cookies(self):
-        cookies = {}
-        cookie_data = self.environ.get('HTTP_COOKIE', '')
-        if cookie_data:
-            _parsed = SimpleCookie()
-            _parsed.load(cookie_data)
-            for name in _parsed:
-                cookies[name] = _parsed[name].value
-        self._request_cookies = cookies
-        self._cookies_parsed = 1
+    # Request cookies are parsed individually as they are looked up, and the
+    # values, or ``None`` for missing cookies, are memoised.
+    def _get_request_cookie(self, name):
+        cookies = self._request_cookies
+        if cookies is None:
+            cookies = self._request_cookies = {}
+        elif name in cookies:
+            return cookies[name]
+        header = self.environ.get('HTTP_COOKIE')
+        if header:
+            value = get_cookie_value(header, name)
+        else:
+            value = None
+        cookies[name] = value
+        return value
 
     def get_cookie(self, name, default=''):
-        if not self._cookies_parsed:
-            self._parse_cookies()
-        return self._request_cookies.get(name, default)
+        value = self._get_request_cookie(name)
+        if value is None:
+            return default
+        return value
 
     def get_secure_cookie(self, name, key=SECURE_COOKIE_KEY, timestamped=True):
-        if not self._cookies_parsed:
-            self._parse_cookies()
-        if name not in self._request_cookies:
+        value = self._get_request_cookie(name)
+        if value is None:
             return
-        return validate_tamper_proof_string(
-            name, self._request_cookies[name], key, timestamped
-            )
+        return validate_tamper_proof_string(name, value, key, timestamped)
+
+    def get_response_cookies(self):
+        cookies = self._response_cookies
+        if cookies is None:
+            cookies = self._response_cookies = {}
+        return cookies
 
     def set_cookie(self, name, value, **kwargs):
-        cookie = self._response_cookies.setdefault(name, {})
+        cookie = self.get_response_cookies().setdefault(name, {})
         cookie['value'] = value
         kwargs.setdefault('path', '/')
         if self.ssl_mode:
@@ -390,14 +703,14 @@ class Context(object):
         self.set_cookie(name, value, **kwargs)
 
     def append_to_cookie(self, name, value):
-        cookie = self._response_cookies.setdefault(name, {})
+        cookie = self.get_response_cookies().setdefault(name, {})
         if 'value' in cookie:
             cookie['value'] = '%s:%s' % (cookie['value'], value)
         else:
             cookie['value'] = value
 
     def expire_cookie(self, name, **kwargs):
-        if name in self._response_cookies:
+        if self._response_cookies and name in self._response_cookies:
             del self._response_cookies[name]
         kwargs.setdefault('path', '/')
         kwargs.update({'max_age': 0, 'expires': "Fri, 31-Dec-99 23:59:59 GMT"})
@@ -410,7 +723,7 @@ class Context(object):
         resp = self.response_headers
         resp['Etag'] = etag
         resp['Cache-Control'] = "private, max-age=%d;" % duration
-        if self.environ.get('HTTP_IF_NONE_MATCH') == etag:
+        if is_not_modified(self.environ, etag, None):
             self.set_response_status(304)
             raise HTTPContent("")
 
@@ -422,7 +735,7 @@ class Context(object):
         resp['Etag'] = etag
         resp['Pragma'] = "Public"
         resp['Cache-Control'] = "public, max-age=%d;" % duration
-        if self.environ.get('HTTP_IF_NONE_MATCH') == etag:
+        if is_not_modified(self.environ, etag, None):
             self.set_response_status(304)
             raise HTTPContent("")
 
@@ -480,13 +793,21 @@ class Context(object):
 
     @property
     def is_admin(self):
-        if not hasattr(self, '_is_admin'):
+        if self._is_admin is UNSET:
             self._is_admin = self.get_admin_status()
         return self._is_admin
 
+    # Handlers with ``raw_body`` set get the POST body as is in ``request_body``.
+    # If they need it, the JSON body is only decoded when this is first used.
+    @property
+    def request_json(self):
+        if self._request_json is UNSET:
+            self._request_json = json_decode(self.request_body)
+        return self._request_json
+
     @property
     def site_url(self):
-        if not hasattr(self, '_site_url'):
+        if self._site_url is None:
             if self.site_host:
                 self._site_url = self.scheme + '://' + self.site_host
             else:
@@ -495,13 +816,13 @@ class Context(object):
 
     @property
     def url(self):
-        if not hasattr(self, '_url'):
+        if self._url is None:
             self._url = self.site_url + self.environ['PATH_INFO']
         return self._url
 
     @property
     def url_with_qs(self):
-        if not hasattr(self, '_url_with_qs'):
+        if self._url_with_qs is None:
             env = self.environ
             query = env['QUERY_STRING']
             self._url_with_qs = (
@@ -512,28 +833,63 @@ class Context(object):
 
     @property
     def user(self):
-        if not hasattr(self, '_user'):
+        if self._user is UNSET:
             self._user = self.get_user()
         return self._user
 
     @property
     def user_id(self):
-        if not hasattr(self, '_user_id'):
+        if self._user_id is UNSET:
             self._user_id = self.get_user_id()
         return self._user_id
 
+    # Signed-in users and admins must send the token derived from their session.
+    # The double-submit ``csrf`` cookie is only accepted from anonymous visitors,
+    # who don't have a session to derive a token from.
     def validate_xsrf(self, token):
-        if not secure_string_comparison(token, self.xsrf_token):
-            raise AuthError("XSRF token does not match.")
-
+        if token:
+            expected = self.xsrf_token
+            if expected:
+                if secure_string_comparison(token, expected):
+                    return
+            else:
+                cookie = self.get_cookie('csrf')
+                if len(cookie) >= 32 and secure_string_comparison(
+                    token, cookie
+                ):
+                    return
+        raise AuthError("XSRF token does not match.")
+
+    # XSRF tokens are derived statelessly from the user's auth or admin cookie,
+    # so that rendering a form doesn't need to set a cookie. Anonymous visitors
+    # are given a random token, which is also set as the ``csrf`` cookie, i.e.
+    # as a double-submit token.
+    #
+    # Pages which are rendered while ``shared_render`` is set are shared between
+    # visitors, e.g. via the page cache, so they get an empty token instead, and
+    # don't set the cookie. Any forms on them are filled in by ``site.js``,
+    # which sets the ``csrf`` cookie itself.
     @property
     def xsrf_token(self):
-        if not self._xsrf_token:
-            xsrf_token = self.get_secure_cookie('xsrf')
-            if not xsrf_token:
-                xsrf_token = hexlify(urandom(18))
-                self.set_secure_cookie('xsrf', xsrf_token)
-            self._xsrf_token = xsrf_token
+        if self._xsrf_token is None:
+            if self.user_id:
+                session = 'auth|' + self.get_cookie('auth')
+            elif self.is_admin:
+                session = 'admin|' + self.get_cookie('admin')
+            else:
+                session = None
+            if session:
+                self._xsrf_token = hmac(
+                    SECURE_COOKIE_KEY, 'xsrf|' + session, sha256
+                    ).hexdigest()
+            elif self.shared_render:
+                return ''
+            else:
+                token = self.get_cookie('csrf')
+                if len(token) < 32:
+                    token = hexlify(urandom(24))
+                    self.set_cookie('csrf', token)
+                self._xsrf_token = token
         return self._xsrf_token
 
     from user import get_admin_status, get_user, get_user_id
@@ -554,12 +910,20 @@ class Context(object):
 
 reqlocal = local()
 
+# Each request records the time taken by the various phases of handling it in
+# ``ctx.timings``. These are aggregated into per-handler histograms, and sent
+# to admins in a ``Server-Timing`` header.
+TIMINGS = Histograms()
+
 def handle_http_request(
-    env, start_response, dict=dict, isinstance=isinstance, urlunquote=urlunquote,
-    unicode=unicode, get_response_headers=lambda: None
+    env, start_response, dict=dict, isinstance=isinstance, unicode=unicode,
+    get_response_headers=lambda: None, leaf_routes=ROUTES.leaves,
+    match_route=ROUTES.match, now=time, record_timings=TIMINGS.record
     ):
 
+    start = now()
     reqlocal.template_error_traceback = None
+    ctx = None
 
     try:
 
@@ -598,115 +962,123 @@ def handle_http_request(
                 for arg in _path_info.split('/') if arg
                 ]
 
-        if _args:
-            name = _args[0]
+        routed = 0
+        route = _args and leaf_routes.get(_args[0])
+        if route:
+            name, handler, renderers, config, plan = route
             args = _args[1:]
+            params = ()
         else:
-            name = '/'
-            args = ()
-
-        routed = 0
-        if name not in HANDLERS:
-            router = handle_http_request.router
-            if router:
-                _info = router(env, _args)
+            route = match_route(_args)
+            if route:
+                (name, handler, renderers, config, plan), args, params = route
+            elif handle_http_request.router:
+                _info = handle_http_request.router(env, _args)
                 if not _info:
                     logging.error("No handler found for: %s" % _path_info)
                     raise NotFound
                 name, args = _info
+                name, handler, renderers, config, plan = HANDLERS[name]
+                params = ()
                 routed = 1
             else:
-                logging.error("Handler not found: %s" % name)
+                logging.error("Handler not found: %s" % _path_info)
                 raise NotFound
 
-        handler, renderers, config = HANDLERS[name]
         kwargs = {}
 
         ctx = Context(name, env, ssl_mode)
         ctx.was_routed = routed
 
-        for part in [
-            sub_part
-            for part in env['QUERY_STRING'].lstrip('?').split('&')
-            for sub_part in part.split(';')
-            ]:
-            if not part:
-                continue
-            part = part.split('=', 1)
-            if len(part) == 1:
-                value = None
-            else:
-                value = part[1]
-            key = urlunquote(part[0].replace('+', ' '))
-            if value:
-                value = unicode(
-                    urlunquote(value.replace('+', ' ')), 'utf-8', 'strict'
-                    )
-            else:
-                value = None
-            kwargs[key] = value
+        decode_query(env['QUERY_STRING'], kwargs)
+
+        mark = now()
+        timings = ctx.timings = [('args', mark - start)]
 
         # Parse the POST body if it exists and is of a known content type.
         if http_method == 'POST':
 
-            content_type = env.get('CONTENT-TYPE', '')
-            if not content_type:
-                content_type = env.get('CONTENT_TYPE', '')
+            # Reject bodies larger than the handler allows before reading any
+            # of it.
+            try:
+                content_length = int(env.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                raise HTTPError(400)
+            if content_length > config['max_body_size']:
+                raise HTTPError(413)
+
+            raw_content_type = env.get('CONTENT-TYPE', '')
+            if not raw_content_type:
+                raw_content_type = env.get('CONTENT_TYPE', '')
 
+            content_type = raw_content_type
             if ';' in content_type:
                 content_type = content_type.split(';', 1)[0]
 
-            if content_type in VALID_REQUEST_CONTENT_TYPES:
+            # Handlers with ``raw_body`` set are left to parse the body
+            # themselves, e.g. so that webhook payloads can be stored as they
+            # were sent.
+            if config['raw_body']:
+                ctx.request_body = env['wsgi.input'].read(content_length)
 
-                post_environ = env.copy()
-                post_environ['QUERY_STRING'] = ''
+            elif content_type in VALID_REQUEST_CONTENT_TYPES:
 
                 if config['post_encoding']:
-                    ctx.request_body = env['wsgi.input'].read()
+                    ctx.request_body = env['wsgi.input'].read(content_length)
                     env['wsgi.input'] = StringIO(ctx.request_body)
                     post_encoding = config['post_encoding']
                 else:
                     post_encoding = 'utf-8'
 
-                post_data = FieldStorage(
-                    environ=post_environ, fp=env['wsgi.input'],
-                    keep_blank_values=True
-                    ).list or []
-
-                for field in post_data:
-                    key = field.name
-                    if field.filename:
-                        if config['blob']:
-                            value = parse_file_info(field)
-                        else:
-                            value = field
+                try:
+                    if content_type == 'multipart/form-data':
+                        post_data = iter_multipart(
+                            env['wsgi.input'], content_length,
+                            get_boundary(raw_content_type)
+                            )
                     else:
-                        value = unicode(field.value, post_encoding, 'strict')
-                    kwargs[key] = value
+                        post_data = iter_urlencoded(
+                            env['wsgi.input'], content_length
+                            )
+                    for key, value in post_data:
+                        if isinstance(value, FileUpload):
+                            if config['blob']:
+                                value = parse_file_info(value)
+                        else:
+                            value = unicode(value, post_encoding, 'strict')
+                        kwargs[key] = value
+                except ParseError, error:
+                    logging.error("Invalid POST body: %s" % error)
+                    raise HTTPError(400)
 
             elif content_type == 'application/json':
-                kwargs.update(json_decode(env['wsgi.input'].read()))
+                kwargs.update(json_decode(env['wsgi.input'].read(content_length)))
+
+            _mark = now()
+            timings.append(('post', _mark - mark))
+            mark = _mark
 
         def get_response_headers():
-            # Figure out the HTTP headers for the response ``cookies``.
-            cookie_output = SimpleCookie()
-            for name, values in ctx._response_cookies.iteritems():
-                name = str(name)
-                cookie_output[name] = values.pop('value')
-                cur = cookie_output[name]
-                for key, value in values.items():
-                    if key == 'max_age':
-                        key = 'max-age'
-                    if key not in COOKIE_KEY_NAMES:
-                        continue
-                    cur[key] = value
-            if cookie_output:
-                raw_headers = ctx._raw_headers + [
-                    ('Set-Cookie', ck.split(' ', 1)[-1])
-                    for ck in str(cookie_output).split('\r\n')
+            _start = now()
+            # Figure out the HTTP headers for the response ``cookies``. These
+            # are never sent with public responses, as they could otherwise
+            # end up in shared caches.
+            cookies = ctx._response_cookies
+            if cookies and is_public_response(ctx, config):
+                logging.warn(
+                    "Dropping cookies from public response in %s: %s"
+                    % (ctx.name, ', '.join(sorted(cookies)))
+                    )
+                cookies = ctx._response_cookies = None
+            if cookies:
+                raw_headers = ctx.get_raw_headers() + [
+                    ('Set-Cookie', format_set_cookie(
+                        str(name), values['value'], values
+                        ))
+                    for name, values in sorted(cookies.iteritems())
                     ]
             else:
-                raw_headers = ctx._raw_headers
+                raw_headers = ctx.get_raw_headers()
             str_headers = []; new_header = str_headers.append
             for k, v in raw_headers:
                 if isinstance(k, unicode):
@@ -714,39 +1086,52 @@ def handle_http_request(
                 if isinstance(v, unicode):
                     v = v.encode('utf-8')
                 new_header((k, v))
+            timings.append(('headers', now() - _start))
             return str_headers
 
         if 'submit' in kwargs:
             del kwargs['submit']
 
-        if RUNNING_ON_GOOGLE_SERVERS:
-            if config['cron']:
-                if not env.get('HTTP_X_APPENGINE_CRON'):
-                    ctx.check_task_auth(kwargs)
-            elif config['task']:
-                if not env.get('HTTP_X_APPENGINE_TASKNAME'):
-                    ctx.check_task_auth(kwargs)
-            elif config['ssl'] and not ssl_mode:
-                raise NotFound
+        # Path parameters from the route take precedence over any parameters
+        # from the query string or POST body.
+        if params:
+            kwargs.update(params)
 
-        if config['xsrf']:
-            if 'xsrf' not in kwargs:
-                raise AuthError("XSRF token not present.")
-            provided_xsrf = kwargs.pop('xsrf')
-            if not secure_string_comparison(provided_xsrf, ctx.xsrf_token):
-                raise AuthError("XSRF token does not match.")
+        for check in plan:
+            check(ctx, kwargs)
 
-        if config['admin'] and not ctx.is_admin:
-            if ctx.user_id:
-                raise NotFound
-            raise Redirect(ctx.get_login_url())
+        validate = config['validate']
+        if validate and http_method != 'POST':
+            apply_validator(
+                ctx, validate(ctx, *args, **kwargs), config['cache']
+                )
 
-        if (not config['anon']) and (not ctx.user_id):
-            raise Redirect(ctx.get_login_url())
+        _mark = now()
+        timings.append(('checks', _mark - mark))
+        mark = _mark
+
+        if config['flush'] and http_method == 'GET':
+            def flush():
+                if ctx.flushed:
+                    return
+                head = ctx.render_mako_template(config['flush'])
+                if 'Content-Type' not in ctx.response_headers:
+                    ctx.response_headers['Content-Type'] = 'text/html; charset=utf-8'
+                write = start_response(
+                    ('%d %s\r\n' % ctx._status), get_response_headers()
+                    )
+                write(head.encode('utf-8'))
+                ctx.flushed = True
+                ctx._flushed_headers = len(ctx.get_raw_headers())
+            ctx._flush = flush
 
         # Try and respond with the result of calling the handler.
         content = handler(ctx, *args, **kwargs)
 
+        _mark = now()
+        timings.append(('handler', _mark - mark))
+        mark = _mark
+
         for renderer in renderers:
             if ctx.end_pipeline:
                 break
@@ -760,13 +1145,23 @@ def handle_http_request(
                     }
             if isinstance(renderer, str):
                 content = ctx.render_mako_template(renderer, **content)
+                phase = 'render.' + renderer
             else:
                 content = renderer(ctx, **content)
-
+                phase = 'render.' + renderer.__name__
+            _mark = now()
+            timings.append((phase, _mark - mark))
+            mark = _mark
+
+        # Handlers can return an iterator, e.g. a generator, to have the
+        # response streamed instead of being built up in memory.
+        streaming = False
         if content is None:
             content = ''
         elif isinstance(content, unicode):
             content = content.encode('utf-8')
+        elif hasattr(content, 'next'):
+            streaming = True
         elif not isinstance(content, str):
             content = str(content)
 
@@ -775,45 +1170,86 @@ def handle_http_request(
                 func(ctx)
 
         cache = config['cache']
-        if cache and http_method != 'POST':
+        if cache and http_method != 'POST' and not validate:
             cache, duration = cache
-            etag = md5(content).hexdigest()
-            if cache == 'public':
-                ctx.cache_response(etag, duration)
-            elif cache == 'private':
-                ctx.cache_private_response(etag, duration)
-            else:
+            if cache == 'no-cache':
                 ctx.do_not_cache_response()
+            elif streaming:
+                # Streamed responses can't be hashed up front, so they are
+                # cached without an ETag.
+                ctx.response_headers['Cache-Control'] = "%s, max-age=%d;" % (
+                    cache, duration
+                    )
+            else:
+                etag = md5(content).hexdigest()
+                if not ctx.compress_key:
+                    ctx.compress_key = etag
+                if cache == 'public':
+                    ctx.cache_response(etag, duration)
+                else:
+                    ctx.cache_private_response(etag, duration)
 
+        timings.append(('after', now() - mark))
         raise HTTPContent(content)
 
     # Return the content.
     except HTTPContent, payload:
 
         content = payload.content
+        streaming = not isinstance(content, str)
+        if ctx.flushed:
+            if ctx._response_cookies or (
+                len(ctx.get_raw_headers()) != ctx._flushed_headers
+                ):
+                logging.error(
+                    "Response headers set after flushing in %s" % ctx.name
+                    )
+            if streaming:
+                return iter_response_chunks(content)
+            return [content]
+
         if 'Content-Type' not in ctx.response_headers:
             ctx.response_headers['Content-Type'] = 'text/html; charset=utf-8'
 
-        ctx.response_headers['Content-Length'] = str(len(content))
+        if not streaming:
+            if config['compress'] and ctx._status[0] == 200:
+                mark = now()
+                content = compress_response(ctx, content)
+                ctx.timings.append(('compress', now() - mark))
+            ctx.response_headers['Content-Length'] = str(len(content))
+
+        if 'HTTP_COOKIE' in env and ctx.is_admin:
+            set_server_timing(ctx, now() - start)
 
         start_response(('%d %s\r\n' % ctx._status), get_response_headers())
         if http_method == 'HEAD':
+            if streaming and hasattr(content, 'close'):
+                content.close()
             return []
 
+        if streaming:
+            return iter_response_chunks(content)
+
         return [content]
 
     # Handle 404s.
     except NotFound:
+        if ctx and ctx.flushed:
+            return [ERROR_404]
         start_response(*RESPONSE_404)
         return [ERROR_404]
 
     # Handle 401s.
     except AuthError:
+        if ctx and ctx.flushed:
+            return [ERROR_401]
         start_response(*RESPONSE_401)
         return [ERROR_401]
 
     # Handle HTTP 301/302 redirects.
     except Redirect, redirect:
+        if ctx and ctx.flushed:
+            return [FLUSHED_REDIRECT % escape(redirect.uri).encode('utf-8')]
         if 'Content-Type' not in ctx.response_headers:
             ctx.response_headers['Content-Type'] = 'text/html; charset=utf-8'
         headers = get_response_headers()
@@ -828,10 +1264,14 @@ def handle_http_request(
 
     # Handle other HTTP response codes.
     except HTTPError, error:
-        start_response(("%s %s" % (error.code, HTTP_STATUS_MESSAGES[error.code])), [])
+        if ctx and ctx.flushed:
+            return []
+        start_response(("%s %s" % (error.code, HTTP_STATUS_MESSAGES[error.code][0])), [])
         return []
 
     except CapabilityDisabledError:
+        if ctx and ctx.flushed:
+            return [ERROR_503]
         start_response(*RESPONSE_503)
         return [ERROR_503]
 
@@ -848,13 +1288,86 @@ def handle_http_request(
             if DEBUG:
                 traceback = HTMLErrorTemplate.render(traceback=template_tb)
         response = ERROR_500_TRACEBACK % traceback
-        start_response(*RESPONSE_500)
         if isinstance(response, unicode):
             response = response.encode('utf-8')
+        if ctx and ctx.flushed:
+            return [response]
+        start_response(*RESPONSE_500)
         return [response]
 
+    # Record the phase timings, including the time taken to generate any error
+    # responses. The time spent streaming a response body isn't included.
+    finally:
+        if ctx is not None and ctx.timings:
+            ctx.timings.append(('total', now() - start))
+            record_timings(ctx.name, ctx.timings)
+
 handle_http_request.router = None
 
+def is_public_response(ctx, config):
+    if ctx.environ['REQUEST_METHOD'] == 'POST':
+        return False
+    cache = config['cache']
+    if cache and cache[0] == 'public':
+        return True
+    cache_control = ctx.response_headers['Cache-Control']
+    return bool(cache_control) and cache_control.startswith('public')
+
+# Public responses could end up in shared caches, so they are never given the
+# timings.
+def set_server_timing(ctx, total):
+    headers = ctx.response_headers
+    cache_control = headers['Cache-Control']
+    if cache_control and cache_control.startswith('public'):
+        return
+    headers['Server-Timing'] = ', '.join(
+        '%s;dur=%.2f' % (phase, duration * 1000)
+        for phase, duration in ctx.timings + [('total', total)]
+        )
+
+TIMING_PHASES = (
+    'args', 'post', 'checks', 'handler', 'after', 'compress', 'headers', 'total'
+    )
+
+# Return the aggregated timing histograms for all registered handlers, keyed
+# by ``(handler, phase)``.
+def get_handler_timings():
+    pairs = []
+    for name, (_, _, renderers, _, _) in HANDLERS.iteritems():
+        for phase in TIMING_PHASES:
+            pairs.append((name, phase))
+        for renderer in renderers:
+            if not isinstance(renderer, str):
+                renderer = renderer.__name__
+            pairs.append((name, 'render.' + renderer))
+    return load_histograms(pairs)
+
+# Encode the chunks from a streamed response, coalescing small chunks so that
+# they don't each end up as a separate write.
+def iter_response_chunks(content, size=16 << 10, unicode=unicode):
+    buf = []; append = buf.append
+    buffered = 0
+    try:
+        for chunk in content:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            elif not isinstance(chunk, str):
+                chunk = str(chunk)
+            append(chunk)
+            buffered += len(chunk)
+            if buffered >= size:
+                yield ''.join(buf)
+                del buf[:]
+                buffered = 0
+        if buffered:
+            yield ''.join(buf)
+    except Exception:
+        logging.critical(''.join(format_exception(*sys.exc_info())))
+        raise
+    finally:
+        if hasattr(content, 'close'):
+            content.close()
+
 # ------------------------------------------------------------------------------
 # Template Error Handling
 # ------------------------------------------------------------------------------
@@ -918,39 +1431,34 @@ def template_error_handler(context, error):
 handle_http_request.template_error_handler = template_error_handler
 
 # ------------------------------------------------------------------------------
-# Monkey Patches
+# Template Cache
 # ------------------------------------------------------------------------------
 
-# The ``mako`` templating system uses ``beaker`` to cache segments and this
-# needs various patches to make appropriate use of Memcache as a cache backend
-# on App Engine.
-#
-# First, the App Engine memcache client needs to be setup as the ``memcache``
-# module.
-import google.appengine.api.memcache as memcache
+# Cached sections in ``mako`` templates, e.g. ``<%block cached="True">``, are
+# stored in a two-tier cache, with an in-process LRU in front of memcache, and
+# with only one request at a time regenerating an expired section.
+TEMPLATE_CACHE = TwoTierCache('mako')
 
-sys.modules['memcache'] = memcache
+class TemplateCacheImpl(CacheImpl):
 
-import beaker.container
-import beaker.ext.memcached
+    def get_key(self, key):
+        return '%s|%s' % (self.cache.id, key)
 
-# And then the beaker ``Value`` object itself needs to be patched.
-class Value(beaker.container.Value):
+    def get_or_create(self, key, creation_function, **kw):
+        return TEMPLATE_CACHE.get_or_create(
+            self.get_key(key), creation_function, kw.get('timeout')
+            )
 
-    def get_value(self):
-        stored, expired, value = self._get_value()
-        if not self._is_expired(stored, expired):
-            return value
+    def set(self, key, value, **kw):
+        TEMPLATE_CACHE.set(self.get_key(key), value, kw.get('timeout'))
 
-        if not self.createfunc:
-            raise KeyError(self.key)
+    def get(self, key, **kw):
+        return TEMPLATE_CACHE.get(self.get_key(key))
 
-        v = self.createfunc()
-        self.set_value(v)
-        return v
+    def invalidate(self, key, **kw):
+        TEMPLATE_CACHE.invalidate(self.get_key(key))
 
-beaker.container.Value = Value
-beaker.ext.memcached.verify_directory = lambda x: None
+register_cache_plugin('weblite', 'weblite', 'TemplateCacheImpl')
 
 # ------------------------------------------------------------------------------
 # Mako
@@ -971,9 +1479,7 @@ class MakoTemplateLookup(object):
         'encoding_errors': 'strict',
         'input_encoding': 'utf-8',
         'module_directory': None,
-        'cache_type': 'memcached',
-        'cache_dir': '.',
-        'cache_url': 'memcached://',
+        'cache_impl': 'weblite',
         'cache_enabled': True,
         'default_filters': ['decode.utf8'],  # will be shared across instances
         'buffer_filters': [],
@@ -981,13 +1487,24 @@ class MakoTemplateLookup(object):
         'preprocessor': None
         }
 
+    # The subset of the template args which apply to precompiled templates.
+    module_template_args = frozenset([
+        'cache_enabled', 'cache_impl', 'disable_unicode', 'encoding_errors',
+        'error_handler', 'format_exceptions', 'output_encoding'
+        ])
+
+    compiled_directory = join('template', 'compiled')
     templates_directory = 'template'
 
     def __init__(self, **kwargs):
         self.template_args = self.default_template_args.copy()
         self.template_args.update(kwargs)
+        self._compiled_manifest = {}
         self._template_cache = {}
         self._template_mtime_data = {}
+        manifest = join(self.compiled_directory, 'manifest.json')
+        if not DEBUG and exists(manifest):
+            self._compiled_manifest = json_decode(read(manifest))
 
     if DEBUG:
 
@@ -1029,6 +1546,13 @@ class MakoTemplateLookup(object):
             if not exists(filepath):
                 raise IOError("Cannot find template %s.mako" % uri)
 
+            if not kwargs:
+                template = self.load_compiled_template(uri, filepath)
+                if template:
+                    return self._template_cache.setdefault(
+                        (uri, kwargs), template
+                        )
+
             if kwargs:
                 _template_args = self.template_args.copy()
                 _template_args.update(dict(kwargs))
@@ -1041,10 +1565,44 @@ class MakoTemplateLookup(object):
 
             return self._template_cache.setdefault((uri, kwargs), template)
 
+    # Templates which have been precompiled by ``tool/compile-templates`` are
+    # loaded from their modules instead of being compiled from source, as long
+    # as the source hasn't changed since.
+    def load_compiled_template(self, uri, filepath):
+        digest = self._compiled_manifest.get(uri)
+        if not digest:
+            return
+        if sha1(read(filepath)).hexdigest() != digest:
+            logging.warn("Ignoring stale compiled template: %s" % uri)
+            return
+        module = load_source(
+            '_mako_%s' % uri.replace('.', '_').replace('-', '_'),
+            join(self.compiled_directory, uri + '.py')
+            )
+        if getattr(module, '_magic_number', None) != MAKO_MAGIC_NUMBER:
+            logging.warn("Ignoring incompatible compiled template: %s" % uri)
+            return
+        args = self.template_args
+        return ModuleTemplate(module, lookup=self, **dict(
+            (key, args[key]) for key in self.module_template_args
+            ))
+
     def adjust_uri(self, uri, relativeto):
         return uri
 
-def get_mako_template(ctx, uri, kwargs=None, lookup=MakoTemplateLookup().get_template):
+    def preload_templates(self):
+        for filename in sorted(listdir(self.templates_directory)):
+            if filename.endswith('.mako'):
+                self.get_template(filename[:-5])
+
+TEMPLATE_LOOKUP = MakoTemplateLookup()
+
+# Load all of the templates up front, e.g. when handling warmup requests, so
+# that user requests don't pay for it.
+def preload_templates():
+    TEMPLATE_LOOKUP.preload_templates()
+
+def get_mako_template(ctx, uri, kwargs=None, lookup=TEMPLATE_LOOKUP.get_template):
     return lookup(uri, kwargs)
 
 def call_mako_template(ctx, template, **kwargs):
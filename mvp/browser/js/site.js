@@ -48,6 +48,26 @@ defpkg('app', function(exports, root) {
     el.style.opacity = '0.1';
   }
 
+  // Anonymous visitors are served forms without an XSRF token, so that the
+  // pages don't need to set any cookies and can be cached. Instead, a random
+  // token is set as the csrf cookie and submitted with the form, i.e. as a
+  // double-submit token.
+  function getXSRFToken() {
+    var match = doc.cookie.match(/(?:^|;\s*)csrf=([0-9a-f]{48})/);
+    if (match) {
+      return match[1];
+    }
+    var bytes = new Uint8Array(24),
+        token = '';
+    (root.crypto || root.msCrypto).getRandomValues(bytes);
+    for (var i = 0; i < bytes.length; i++) {
+      token += ('0' + bytes[i].toString(16)).slice(-2);
+    }
+    doc.cookie = 'csrf=' + token + '; path=/' +
+      (loc.protocol === 'https:' ? '; secure' : '');
+    return token;
+  }
+
   function hasClass(el, className) {
     if (el.classList) {
       return el.classList.contains(className);
@@ -69,6 +89,7 @@ defpkg('app', function(exports, root) {
     initParticles();
     initPaymentForm();
     initPriceUpdater();
+    initXSRF();
   }
 
   function initCampaignContent() {
@@ -675,6 +696,19 @@ defpkg('app', function(exports, root) {
     bindClick($('navicon'), toggle);
   }
 
+  function initXSRF() {
+    var fields = doc.getElementsByName('xsrf'),
+        token = '';
+    for (var i = 0; i < fields.length; i++) {
+      if (!fields[i].value) {
+        if (!token) {
+          token = getXSRFToken();
+        }
+        fields[i].value = token;
+      }
+    }
+  }
+
   function insertScript(url, async) {
     var a = doc.createElement('script'),
         m = doc.getElementsByTagName('script')[0];
@@ -0,0 +1,576 @@
+# Public Domain (-) 2017 The GitFund Authors.
+# See the GitFund UNLICENSE file for details.
+
+"""In-memory stand-ins for the App Engine datastore and memcache APIs.
+
+Calling ``install`` registers fake ``google.appengine.ext.db`` and
+``google.appengine.api.memcache`` modules, and puts the app directory on the
+path, so that the tools can drive the real app modules, e.g. ``slots`` and
+``generations``, outside of the SDK.
+
+Only the parts of the APIs that those modules use are supported. Like the
+datastore, transactions use optimistic concurrency per entity group: a commit
+fails if any of the groups it touched were written to after it first touched
+them, and the transaction function is then retried up to 3 times. Every
+datastore RPC sleeps for ``LATENCY`` seconds, and is counted in ``STATS`` and,
+by method, in ``CALLS``.
+"""
+
+import os
+import sys
+
+from copy import deepcopy
+from itertools import count
+from threading import Lock, local
+from time import sleep
+from types import ModuleType
+
+APP_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'
+    )
+
+LATENCY = 0
+
+STATS = dict.fromkeys(['commits', 'failed', 'retries', 'rpcs'], 0)
+
+# ------------------------------------------------------------------------------
+# RPCs
+# ------------------------------------------------------------------------------
+
+# The number of datastore RPCs made, by method.
+CALLS = {}
+
+def make_call(call):
+    with STORE.lock:
+        CALLS[call] = CALLS.get(call, 0) + 1
+        STATS['rpcs'] += 1
+    if LATENCY:
+        sleep(LATENCY)
+
+# ------------------------------------------------------------------------------
+# Keys
+# ------------------------------------------------------------------------------
+
+class Key(object):
+
+    __slots__ = ('path',)
+
+    def __init__(self, encoded=None):
+        path = []
+        if encoded:
+            for elem in encoded.split('/'):
+                kind, id_or_name = elem.split(':', 1)
+                if id_or_name[0] == 'i':
+                    path.append((kind, int(id_or_name[1:])))
+                else:
+                    path.append((kind, id_or_name[1:]))
+        self.path = tuple(path)
+
+    def __eq__(self, other):
+        return isinstance(other, Key) and self.path == other.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Key(%r)' % str(self)
+
+    def __str__(self):
+        return '/'.join(
+            '%s:%s%s' % (
+                kind, isinstance(id_or_name, basestring) and 'n' or 'i',
+                id_or_name
+            )
+            for kind, id_or_name in self.path
+        )
+
+    @staticmethod
+    def from_path(*args, **kwargs):
+        parent = kwargs.get('parent')
+        key = Key()
+        path = []
+        if parent is not None:
+            path.extend(parent.path)
+        for idx in range(0, len(args), 2):
+            path.append((args[idx], args[idx+1]))
+        key.path = tuple(path)
+        return key
+
+    def group(self):
+        return self.path[0]
+
+    def id(self):
+        id_or_name = self.path[-1][1]
+        if isinstance(id_or_name, (int, long)):
+            return id_or_name
+
+    def id_or_name(self):
+        return self.path[-1][1]
+
+    def kind(self):
+        return self.path[-1][0]
+
+    def name(self):
+        id_or_name = self.path[-1][1]
+        if isinstance(id_or_name, basestring):
+            return id_or_name
+
+    def parent(self):
+        if len(self.path) > 1:
+            key = Key()
+            key.path = self.path[:-1]
+            return key
+
+def to_key(value):
+    if isinstance(value, Key):
+        return value
+    if isinstance(value, Model):
+        return value.key()
+    return Key(value)
+
+# ------------------------------------------------------------------------------
+# Store
+# ------------------------------------------------------------------------------
+
+class Error(Exception):
+    pass
+
+class TransactionFailedError(Error):
+    pass
+
+class Conflict(Exception):
+    pass
+
+class Store(object):
+
+    def __init__(self):
+        self.data = {}
+        self.ids = count(1)
+        self.lock = Lock()
+        self.versions = {}
+
+    def read(self, key, txn):
+        with self.lock:
+            if txn is not None:
+                txn.touch(key.group(), self.versions)
+            return deepcopy(self.data.get(key))
+
+    def write(self, writes):
+        for key, value in writes:
+            if value is None:
+                self.data.pop(key, None)
+            else:
+                self.data[key] = value
+            group = key.group()
+            self.versions[group] = self.versions.get(group, 0) + 1
+
+STORE = Store()
+
+LOCAL = local()
+
+class Transaction(object):
+
+    def __init__(self):
+        self.groups = {}
+        self.writes = []
+
+    def commit(self):
+        with STORE.lock:
+            for group, version in self.groups.iteritems():
+                if STORE.versions.get(group, 0) != version:
+                    raise Conflict
+            STORE.write(self.writes)
+            STATS['commits'] += 1
+
+    def touch(self, group, versions):
+        if group not in self.groups:
+            self.groups[group] = versions.get(group, 0)
+
+def create_transaction_options(**kwargs):
+    return kwargs
+
+def get_transaction():
+    return getattr(LOCAL, 'txn', None)
+
+def is_in_transaction():
+    return get_transaction() is not None
+
+def reset():
+    with STORE.lock:
+        STORE.data.clear()
+        STORE.versions.clear()
+        CALLS.clear()
+        for stat in STATS:
+            STATS[stat] = 0
+
+def run_in_transaction(func, *args, **kwargs):
+    return run_in_transaction_options({}, func, *args, **kwargs)
+
+def run_in_transaction_options(options, func, *args, **kwargs):
+    if is_in_transaction():
+        raise Error("Nested transactions are not supported")
+    for attempt in range(options.get('retries', 3) + 1):
+        txn = LOCAL.txn = Transaction()
+        make_call('BeginTransaction')
+        try:
+            result = func(*args, **kwargs)
+            make_call('Commit')
+            txn.commit()
+            return result
+        except Conflict:
+            with STORE.lock:
+                STATS['retries'] += 1
+        finally:
+            LOCAL.txn = None
+    with STORE.lock:
+        STATS['failed'] += 1
+    raise TransactionFailedError(
+        "The transaction could not be committed. Please try again."
+    )
+
+# ------------------------------------------------------------------------------
+# Datastore Calls
+# ------------------------------------------------------------------------------
+
+class Result(object):
+
+    def __init__(self, value):
+        self.value = value
+
+    def get_result(self):
+        return self.value
+
+def delete(keys):
+    if not isinstance(keys, (list, tuple)):
+        keys = [keys]
+    keys = [to_key(key) for key in keys]
+    make_call('Delete')
+    writes = [(key, None) for key in keys]
+    txn = get_transaction()
+    if txn is None:
+        with STORE.lock:
+            STORE.write(writes)
+        return
+    with STORE.lock:
+        for key in keys:
+            txn.touch(key.group(), STORE.versions)
+    txn.writes.extend(writes)
+
+def delete_async(keys):
+    return Result(delete(keys))
+
+def get(keys):
+    multiple = isinstance(keys, (list, tuple))
+    if not multiple:
+        keys = [keys]
+    keys = [to_key(key) for key in keys]
+    make_call('Get')
+    txn = get_transaction()
+    results = []
+    for key in keys:
+        data = STORE.read(key, txn)
+        if data is None:
+            results.append(None)
+        else:
+            results.append(load_entity(key, data))
+    if multiple:
+        return results
+    return results[0]
+
+def get_async(keys):
+    return Result(get(keys))
+
+def load_entity(key, values):
+    entity = KIND_MAP[key.kind()].__new__(KIND_MAP[key.kind()])
+    entity._key = key
+    entity._parent = key.parent()
+    entity._values = values
+    return entity
+
+def put(entities):
+    multiple = isinstance(entities, (list, tuple))
+    if not multiple:
+        entities = [entities]
+    for entity in entities:
+        if entity._key is None:
+            entity._key = Key.from_path(
+                entity.kind(), STORE.ids.next(), parent=entity._parent
+            )
+    make_call('Put')
+    writes = [
+        (entity._key, deepcopy(entity._values)) for entity in entities
+    ]
+    txn = get_transaction()
+    if txn is None:
+        with STORE.lock:
+            STORE.write(writes)
+    else:
+        with STORE.lock:
+            for entity in entities:
+                txn.touch(entity._key.group(), STORE.versions)
+        txn.writes.extend(writes)
+    keys = [entity._key for entity in entities]
+    if multiple:
+        return keys
+    return keys[0]
+
+def put_async(entities):
+    return Result(put(entities))
+
+# ------------------------------------------------------------------------------
+# Models
+# ------------------------------------------------------------------------------
+
+KIND_MAP = {}
+
+class Property(object):
+
+    def __init__(self, default=None, indexed=True, **kwargs):
+        self.default = default
+        self.name = None
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        values = instance._values
+        if self.name not in values:
+            values[self.name] = self.get_default()
+        return values[self.name]
+
+    def __set__(self, instance, value):
+        instance._values[self.name] = value
+
+    def get_default(self):
+        return self.default
+
+class ListProperty(Property):
+
+    def __init__(self, item_type, default=None, **kwargs):
+        super(ListProperty, self).__init__(default, **kwargs)
+
+    def get_default(self):
+        return list(self.default or [])
+
+BlobProperty = BooleanProperty = ByteStringProperty = DateTimeProperty = \
+    IntegerProperty = StringProperty = TextProperty = Property
+
+class PropertiedClass(type):
+
+    def __init__(cls, name, bases, attrs):
+        super(PropertiedClass, cls).__init__(name, bases, attrs)
+        properties = {}
+        for base in bases:
+            properties.update(getattr(base, '_properties', {}))
+        for attr, value in attrs.iteritems():
+            if isinstance(value, Property):
+                value.name = attr
+                properties[attr] = value
+        cls._properties = properties
+        KIND_MAP[name] = cls
+
+class Model(object):
+
+    __metaclass__ = PropertiedClass
+
+    def __init__(self, parent=None, key_name=None, key=None, **kwargs):
+        if isinstance(parent, Model):
+            parent = parent.key()
+        self._parent = parent
+        self._values = {}
+        if key is not None:
+            self._key = key
+        elif key_name is not None:
+            self._key = Key.from_path(self.kind(), key_name, parent=parent)
+        else:
+            self._key = None
+        for attr, prop in self._properties.iteritems():
+            if attr in kwargs:
+                self._values[attr] = kwargs[attr]
+            else:
+                self._values[attr] = prop.get_default()
+
+    @classmethod
+    def all(cls, keys_only=False):
+        return Query(cls, keys_only)
+
+    def delete(self):
+        delete(self.key())
+
+    # Like the SDK, these look up the keys with the module-level ``get``, and
+    # not ``cls.get``.
+    @classmethod
+    def get(cls, keys, **kwargs):
+        return get(keys)
+
+    @classmethod
+    def get_by_id(cls, ids, parent=None, **kwargs):
+        return cls.get_by_path(ids, parent)
+
+    @classmethod
+    def get_by_key_name(cls, key_names, parent=None, **kwargs):
+        return cls.get_by_path(key_names, parent)
+
+    @classmethod
+    def get_by_path(cls, ids, parent):
+        if isinstance(parent, Model):
+            parent = parent.key()
+        if isinstance(ids, (list, tuple)):
+            return get([
+                Key.from_path(cls.kind(), id, parent=parent) for id in ids
+            ])
+        return get(Key.from_path(cls.kind(), ids, parent=parent))
+
+    def is_saved(self):
+        return self._key is not None
+
+    def key(self):
+        return self._key
+
+    @classmethod
+    def kind(cls):
+        return cls.__name__
+
+    def put(self):
+        return put(self)
+
+# ------------------------------------------------------------------------------
+# Queries
+# ------------------------------------------------------------------------------
+
+OPERATORS = {
+    '=': lambda a, b: a == b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+}
+
+class Query(object):
+
+    def __init__(self, model, keys_only):
+        self.ancestor_key = None
+        self.filters = []
+        self.keys_only = keys_only
+        self.model = model
+
+    def __iter__(self):
+        return iter(self.run())
+
+    def ancestor(self, key):
+        self.ancestor_key = to_key(key)
+        return self
+
+    def fetch(self, limit):
+        return self.run()[:limit]
+
+    def filter(self, spec, value):
+        prop, op = (spec.split() + ['='])[:2]
+        self.filters.append((prop, OPERATORS[op], value))
+        return self
+
+    def run(self, **kwargs):
+        make_call('RunQuery')
+        kind = self.model.kind()
+        ancestor = self.ancestor_key
+        txn = get_transaction()
+        with STORE.lock:
+            if txn is not None and ancestor is not None:
+                txn.touch(ancestor.group(), STORE.versions)
+            matches = []
+            for key, values in sorted(
+                STORE.data.iteritems(), key=lambda item: item[0].path
+            ):
+                if key.kind() != kind:
+                    continue
+                if ancestor and key.path[:len(ancestor.path)] != ancestor.path:
+                    continue
+                for prop, op, value in self.filters:
+                    if not op(values.get(prop), value):
+                        break
+                else:
+                    matches.append((key, deepcopy(values)))
+        if self.keys_only:
+            return [key for key, _ in matches]
+        return [load_entity(key, values) for key, values in matches]
+
+# ------------------------------------------------------------------------------
+# Memcache
+# ------------------------------------------------------------------------------
+
+CACHE = {}
+CACHE_LOCK = Lock()
+
+def cache_add(key, value, time=0, namespace=None):
+    with CACHE_LOCK:
+        if (namespace, key) in CACHE:
+            return False
+        CACHE[namespace, key] = value
+        return True
+
+def cache_delete(key, seconds=0, namespace=None):
+    with CACHE_LOCK:
+        CACHE.pop((namespace, key), None)
+        return 2
+
+def cache_get(key, namespace=None):
+    with CACHE_LOCK:
+        return CACHE.get((namespace, key))
+
+def cache_get_multi(keys, key_prefix='', namespace=None):
+    with CACHE_LOCK:
+        return dict(
+            (key, CACHE[namespace, key_prefix + key]) for key in keys
+            if (namespace, key_prefix + key) in CACHE
+        )
+
+def cache_incr(key, delta=1, namespace=None, initial_value=None):
+    with CACHE_LOCK:
+        value = CACHE.get((namespace, key))
+        if value is None:
+            if initial_value is None:
+                return None
+            value = initial_value
+        value = CACHE[namespace, key] = max(0, value + delta)
+        return value
+
+def cache_set(key, value, time=0, namespace=None):
+    with CACHE_LOCK:
+        CACHE[namespace, key] = value
+        return True
+
+# ------------------------------------------------------------------------------
+# Install
+# ------------------------------------------------------------------------------
+
+def create_module(name, **attrs):
+    module = sys.modules[name] = ModuleType(name)
+    module.__dict__.update(attrs)
+    return module
+
+def install():
+    this = sys.modules[__name__]
+    google = create_module('google')
+    google.appengine = create_module('google.appengine')
+    google.appengine.api = create_module('google.appengine.api')
+    google.appengine.ext = create_module('google.appengine.ext')
+    google.appengine.api.memcache = create_module(
+        'google.appengine.api.memcache', add=cache_add, delete=cache_delete,
+        get=cache_get, get_multi=cache_get_multi, incr=cache_incr,
+        set=cache_set
+    )
+    db = google.appengine.ext.db = create_module('google.appengine.ext.db')
+    for name in [
+        'BlobProperty', 'BooleanProperty', 'ByteStringProperty',
+        'DateTimeProperty', 'Error', 'IntegerProperty', 'Key',
+        'ListProperty', 'Model', 'StringProperty', 'TextProperty',
+        'TransactionFailedError', 'create_transaction_options', 'delete',
+        'delete_async', 'get', 'get_async', 'is_in_transaction', 'put',
+        'put_async',
+        'run_in_transaction', 'run_in_transaction_options'
+    ]:
+        setattr(db, name, getattr(this, name))
+    if APP_DIRECTORY not in sys.path:
+        sys.path.insert(0, APP_DIRECTORY)